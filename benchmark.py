@@ -0,0 +1,227 @@
+"""
+Benchmarks for smartbackup.
+
+Generates reproducible synthetic source trees, then times each phase of a full (-a) and of an incremental
+backup of them: scanning, hashing the destination, comparing the source and copying. Every phase is reported
+in files/s and MB/s along with the peak RSS of the process, and the results are stored as JSON so runs from
+before and after a change can be compared with --compare.
+
+Usage: benchmark.py [--shape tiny|huge|deep|mixed] [--changed PERCENT] [--root DIR] [-o results.json] [options]
+Use a tmpfs --root (like /dev/shm) to measure smartbackup rather than the disk.
+"""
+
+import json
+from argparse import ArgumentParser
+from os import makedirs, utime, stat
+from os.path import join
+from platform import platform, python_version
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp, gettempdir
+from time import perf_counter
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    # Windows has no resource module, peak RSS is left out there
+    getrusage = None
+
+import smartbackup
+from smartbackup import DEFAULT_ALGORITHM, HashPool, Manifest, compare_hashes, copyfiles, destination_hashes, \
+    get_baseline, get_len, parse_algorithm, parse_size, scan_tree, set_read_size
+
+# Tree shapes as (number of files, size of each file in bytes, depth of the folders, files per folder)
+SHAPES = {
+    "tiny": (20000, 1024, 3, 100),
+    "huge": (4, 256 * 1024 * 1024, 1, 4),
+    "deep": (2000, 16 * 1024, 64, 1),
+    "mixed": (5000, 64 * 1024, 6, 50),
+}
+
+
+# Write size pseudo random bytes to path. The same rng state always gives the same file
+def write_file(path, size, rng):
+    with open(path, "wb") as f:
+        while size > 0:
+            block = min(size, 1024 * 1024)
+            f.write(rng.getrandbits(block * 8).to_bytes(block, "little"))
+            size -= block
+
+
+# Build a source tree of the given shape under folder. Returns the list of files created
+def make_tree(folder, files, size, depth, per_folder, rng):
+    paths = []
+    for i in range(files):
+        # Every per_folder files go in the next folder down a branch, a new branch starts every depth folders
+        branch, level = divmod(i // per_folder, depth)
+        folder_path = join(folder, f"b{branch}", *[f"l{k}" for k in range(level)])
+        makedirs(folder_path, exist_ok=True)
+        path = join(folder_path, f"f{i}.bin")
+        write_file(path, size, rng)
+        paths.append(path)
+    return paths
+
+
+# Rewrite percent of the files with new content of the same size and a newer modification time
+def change_tree(paths, percent, rng):
+    changed = rng.sample(paths, int(len(paths) * percent / 100))
+    for path in changed:
+        st = stat(path)
+        write_file(path, st.st_size, rng)
+        utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    return changed
+
+
+def peak_rss():
+    if getrusage is None:
+        return None
+    # Kilobytes on Linux
+    return getrusage(RUSAGE_SELF).ru_maxrss
+
+
+class Timer:
+    """
+    Times one phase and records how many files and bytes it went through.
+    """
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = perf_counter() - self.start
+        self.results[self.name] = {
+            "seconds": round(seconds, 4),
+            "files": self.files,
+            "bytes": self.bytes,
+            "files_per_s": round(self.files / seconds, 1) if seconds else None,
+            "mb_per_s": round(self.bytes / seconds / 1e6, 2) if seconds else None,
+            "peak_rss_kib": peak_rss(),
+        }
+        print(f"  {self.name:<22} {seconds:8.3f} s {self.results[self.name]['files_per_s']:>10} files/s "
+              f"{self.results[self.name]['mb_per_s']:>9} MB/s")
+
+
+# Count the files and bytes of a tree
+def tree_size(folder):
+    files = 0
+    size = 0
+    for key, entries in scan_tree(folder):
+        for file, st in entries:
+            files += 1
+            size += st.st_size
+    return files, size
+
+
+# Back up a fresh tree of the given shape with -a, change some of it and back it up again incrementally
+def run(shape, root, changed, seed, algorithm, jobs, processes):
+    files, size, depth, per_folder = SHAPES[shape]
+    rng = Random(seed)
+    work = mkdtemp(prefix="smartbackup-bench-", dir=root)
+    source = join(work, "src") + smartbackup.slash
+    destination = join(work, "dst") + smartbackup.slash
+    makedirs(destination)
+    results = {}
+    pool = HashPool(jobs, processes)
+    try:
+        print(f"{shape}: generating {files} files of {size} bytes")
+        paths = make_tree(source, files, size, depth, per_folder, rng)
+        total_files, total_bytes = tree_size(source)
+
+        print(f"{shape}: full backup")
+        with Timer(results, "full_scan") as timer:
+            contents = get_baseline(source)
+            timer.files, timer.bytes = get_len(contents), total_bytes
+        manifest = Manifest(destination)
+        with Timer(results, "full_copy") as timer:
+            copyfiles(contents, source, destination + "2000-1-1.1", manifest, {}, algorithm, jobs)
+            timer.files, timer.bytes = total_files, total_bytes
+        manifest.close()
+
+        print(f"{shape}: changing {changed}% of the files")
+        changed_files = change_tree(paths, changed, rng)
+        changed_bytes = sum(stat(path).st_size for path in changed_files)
+
+        print(f"{shape}: incremental backup")
+        manifest = Manifest(destination)
+        manifest.clear()
+        with Timer(results, "hash_destination_cold") as timer:
+            destination_hashes(destination, algorithm, manifest, pool, None, True)
+            timer.files, timer.bytes = total_files, total_bytes
+        manifest.close()
+        manifest = Manifest(destination)
+        sizes = set()
+        with Timer(results, "hash_destination") as timer:
+            baseline = destination_hashes(destination, algorithm, manifest, pool, sizes)
+            timer.files, timer.bytes = total_files, total_bytes
+        with Timer(results, "compare_paranoid") as timer:
+            compare_hashes(source, baseline, algorithm, {}, manifest, True, pool, None, sizes)
+            timer.files, timer.bytes = total_files, total_bytes
+        digests = {}
+        with Timer(results, "compare") as timer:
+            contents = compare_hashes(source, baseline, algorithm, digests, manifest, False, pool, None, sizes)
+            timer.files, timer.bytes = total_files, total_bytes
+        with Timer(results, "incremental_copy") as timer:
+            copyfiles(contents, source, destination + "2000-1-1.2", manifest, digests, algorithm, jobs)
+            timer.files, timer.bytes = len(changed_files), changed_bytes
+        # The run after that only checks the new folder by stat, the full backup comes from the manifest
+        with Timer(results, "hash_destination_next") as timer:
+            destination_hashes(destination, algorithm, manifest, pool, set())
+            timer.files, timer.bytes = total_files + len(changed_files), total_bytes + changed_bytes
+        manifest.close()
+    finally:
+        pool.close()
+        rmtree(work, ignore_errors=True)
+    return {"shape": shape, "files": files, "size": size, "depth": depth, "changed_percent": changed,
+            "phases": results}
+
+
+# Print how much faster (above 1) or slower (below 1) every phase of results is than in the baseline file
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {shape["shape"]: shape["phases"] for shape in json.load(f)["runs"]}
+    print(f"Compared to {baseline_path}:")
+    for shape in results["runs"]:
+        for phase, numbers in shape["phases"].items():
+            before = baseline.get(shape["shape"], {}).get(phase)
+            if before and before["seconds"] and numbers["seconds"]:
+                print(f"  {shape['shape']:<6} {phase:<22} x{before['seconds'] / numbers['seconds']:.2f}")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Time the phases of smartbackup on synthetic trees")
+    parser.add_argument("--shape", choices=list(SHAPES) + ["all"], default="all")
+    parser.add_argument("--changed", type=float, default=1.0, help="percent of files changed between runs")
+    parser.add_argument("--root", default=gettempdir(), help="where to generate the trees, tmpfs or disk")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--hash", default=DEFAULT_ALGORITHM, type=parse_algorithm, dest="algorithm")
+    parser.add_argument("--buffer-size", default="64K", type=parse_size)
+    parser.add_argument("-j", type=int, default=1, dest="jobs")
+    parser.add_argument("--processes", action="store_true")
+    parser.add_argument("-o", "--output", default="bench_results.json")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+    options = parser.parse_args()
+
+    # Keep smartbackup quiet, only the timings are printed
+    smartbackup.cli = smartbackup.Cli()
+    smartbackup.cli.verbosity = 0
+    set_read_size(options.buffer_size)
+    shapes = list(SHAPES) if options.shape == "all" else [options.shape]
+    results = {
+        "meta": {"python": python_version(), "platform": platform(), "root": options.root, "seed": options.seed,
+                 "algorithm": options.algorithm, "buffer_size": options.buffer_size, "jobs": options.jobs,
+                 "processes": options.processes},
+        "runs": [run(shape, options.root, options.changed, options.seed, options.algorithm, options.jobs,
+                     options.processes) for shape in shapes],
+    }
+    with open(options.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {options.output}")
+    if options.compare:
+        compare(results, options.compare)
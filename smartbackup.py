@@ -22,12 +22,67 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import atexit
 import hashlib
-from os import mkdir, walk
-from shutil import copy2
+import json
+import bz2
+import lzma
+import re
+import sqlite3
+import struct
+import zlib
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from os import chmod, close, fsdecode, fsencode, fstat, fsync, getpid, link, makedirs, mkdir, read, remove, replace, \
+    scandir, stat, strerror, utime
+from os.path import abspath, basename, dirname, join, normpath, relpath, sep
+from select import select
+from stat import S_ISREG
+from shutil import copyfileobj, copystat, rmtree
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
-from platform import system
+from functools import lru_cache, partial
+from time import monotonic, sleep
+from platform import machine, system
+from random import Random
+from queue import Queue
+from threading import Lock, Thread, get_ident
 from sys import argv
+try:
+    from fcntl import ioctl
+except ImportError:
+    # Windows has no ioctl, reflinks fall back to hardlinks
+    ioctl = None
+try:
+    from os import copy_file_range
+except ImportError:
+    # Only Linux has copy_file_range
+    copy_file_range = None
+try:
+    from os import sendfile
+except ImportError:
+    sendfile = None
+try:
+    from os import fdatasync, posix_fadvise, POSIX_FADV_DONTNEED
+except ImportError:
+    # Not on Windows or macOS, --drop-cache does nothing there
+    posix_fadvise = None
+try:
+    from os import nice
+except ImportError:
+    nice = None
+try:
+    import zstandard
+except ImportError:
+    # zstd compression of packs needs the zstandard package
+    zstandard = None
+try:
+    import numpy
+except ImportError:
+    # Without numpy, --chunked finds chunk boundaries one byte at a time in Python
+    numpy = None
 # from tkinter import Tk, Entry, Label, IntVar, Checkbutton, Button, W, E
 from pathlib import Path
 
@@ -59,81 +114,206 @@ def printprogressbar(iteration, total, prefix='', suffix='', decimals=1, length=
         print()
 
 
+class Progress:
+    """
+    Progress of one phase of a run (hashing, copying...), counted in files and in bytes.
+    The terminal is redrawn at most rate times a second, with the throughput in MB/s and files/s,
+    and a bar with the time left when the totals are known up front.
+    """
+
+    def __init__(self, prefix, total_files=None, total_bytes=None, rate=10):
+        self.prefix = prefix
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = 1 / rate
+        self.files = 0
+        self.bytes = 0
+        self.start = monotonic()
+        self.drawn = self.start
+        try:
+            self.quiet = cli.verbosity == 0
+        except NameError:
+            self.quiet = False
+
+    def update(self, files=1, size=0):
+        self.files += files
+        self.bytes += size
+        if monotonic() - self.drawn >= self.interval:
+            self.draw()
+
+    def draw(self, end=False):
+        if self.quiet:
+            return
+        self.drawn = monotonic()
+        elapsed = max(self.drawn - self.start, 1e-6)
+        speed = f"{self.bytes / elapsed / 1e6:.1f} MB/s {self.files / elapsed:.0f} files/s"
+        if self.total_files:
+            # Time left goes by bytes when the phase knows how many, else by files
+            if self.total_bytes:
+                done = self.bytes / self.total_bytes
+            else:
+                done = self.files / self.total_files
+            left = elapsed / done - elapsed if done else 0
+            eta = f"ETA {int(left // 3600)}:{int(left % 3600 // 60):02}:{int(left % 60):02}" if done else "ETA --"
+            # The bar only reaches the end, and the next line, once the phase is done
+            iteration = self.total_files if end else min(done, 0.999) * self.total_files
+            printprogressbar(iteration, self.total_files, prefix=self.prefix, suffix=f"{speed} {eta}", length=50)
+        else:
+            print(f"\r{self.prefix} {self.files} files, {self.bytes / 1e6:.1f} MB, {speed}", end="\n" if end else "\r")
+
+    # Draw the final state of the phase and move to the next line. A phase without totals that was over
+    # before it was ever drawn stays silent, so idle passes don't print anything
+    def done(self):
+        if self.total_files or self.drawn > self.start:
+            self.draw(end=True)
+
+
 class Cli:
     helptxt = """
                 Usage: smartbackup.py -s [source] -d [destination] [options]
+                       smartbackup.py -d [destination] --rebuild-index
+                       smartbackup.py restore -d [destination] -p [path] -o [target] [--at date]
+                       smartbackup.py ls -d [destination] [-p path] [--at date]
+                       smartbackup.py find -d [destination] -p [pattern] [--at date]
+                       smartbackup.py verify -d [destination] [--sample share] [-o report.json]
 
                 Options:
                     -s          Source of the directory you want to backup  (REQUIRED)
                     -d          Destination of the directory you want to copy to (REQUIRED)
-                    -h          Specify hash type to use for file validation
-                                    Supported hash types: MD5, SHA1, SHA224, SHA256, SHA384, SHA512
+                    -h          Specify hash type to use for file validation (default: the one the destination
+                                was backed up with, else BLAKE2B)
+                                    Supported hash types: MD5, SHA1, SHA224, SHA256, SHA384, SHA512, SHA3_256...,
+                                    BLAKE2B, BLAKE2S. Add -N to BLAKE2B or BLAKE2S for an N byte digest: BLAKE2B-16
                     -a          Skip "smart" detection, copy all files regardless of changes
                     -q          Run silently, no output, faster runtime
-                    -v          Run verbose, output everything to console (very slow)
+                    -v          Run verbose, output everything to console (slower)
                     -l          Log output to a file, specify the directory. Use with -v to get all output written to file
+                    -j          Number of files to hash or copy at the same time (default 1)
+                    --processes Hash on worker processes instead of threads, faster for many small files
+                    --buffer-size
+                                Bytes read at a time when hashing, like 256K or 1M (default 64K)
+                    --large-jobs
+                                Most files of 16 MiB or more copied at the same time with -j (default 2)
+                    --link      Hardlink unchanged files from earlier backups, so every backup folder is a full snapshot
+                    --reflink   Like --link, but clone unchanged files where the filesystem supports it
+                    --chunked   Store files as deduplicated chunks in a chunk store instead of a folder of copies.
+                                Chunks are cut at about 8 MB/s per file, 80 MB/s with the numpy package
+                    --pack      Write the files of a backup into a few pack files with an index, instead of one copy
+                                per file
+                    --compress  Compression of the files in packs: none, gzip, bz2, lzma or zstd (default none)
+                    --watch     Keep running and back up files a few seconds after they change (Linux only)
+                    --resume    Finish the last backup if it was interrupted, instead of starting a new one
+                    --bwlimit   Most bytes read and written per second, like 50M, or 50M:20M for reads:writes
+                    --iops      Most reads and writes per second
+                    --nice      Run with a lower CPU priority, by this much (Unix only)
+                    --ionice    I/O priority: idle, best-effort or realtime, with an optional :level from 0 to 7
+                                (Linux only)
+                    --drop-cache
+                                Keep the files read and written out of the page cache (Linux only)
+                    --paranoid  Hash every source file, even the ones whose size and modification time are unchanged,
+                                and check every backup folder by stat, not only the newest one
+                    --rebuild-index
+                                Re-hash the whole destination and regenerate its manifest, then exit (-s not needed)
+
+                Commands
+                    restore     Copy path (a file or a folder, everything by default) as it was backed up at
+                                --at back out to the target folder -o
+                    ls          List the folder path as it was backed up at --at
+                    find        List the backed up files matching a pattern like "*.txt" or "docs/*" as of --at
+                    verify      Check backed up files against their recorded digests and report the missing or
+                                corrupted ones as JSON. Each run carries on where the last one stopped
+                    -p          Path or pattern in the source, relative to the source folder
+                    -o          Folder to restore into, or file to write the verify report to
+                    --sample    Share of the backups (like 0.1) or bytes (like 10G) verify checks per run
+                    --at        Date like 2024-01-31 or 2024-01-31T18:00, the newest backup at or before it is used
+                                (default: now)
 
                 Notes
                     Directories or files with spaces must use quotations around the entire path.
                 """
 
     def __init__(self):
-        self.switches = ["s", "d", "h", "a", "q", "v", "l"]
+        self.switches = ["s", "d", "h", "a", "q", "v", "l", "j", "p", "o"]
+        # Commands that work on existing backups instead of taking one
+        self.commands = ["restore", "ls", "find", "verify"]
+        self.command = None
+        # Long switches, spelled out in full
+        self.long_switches = ["--rebuild-index", "--paranoid", "--processes", "--large-jobs", "--link", "--reflink",
+                              "--chunked", "--buffer-size", "--watch", "--resume", "--pack", "--compress", "--at",
+                              "--sample", "--bwlimit", "--iops", "--nice", "--ionice", "--drop-cache"]
+        # Switches that are not followed by a value
+        self.flags = ["-a", "-q", "-v", "--rebuild-index", "--paranoid", "--processes", "--link", "--reflink",
+                      "--chunked", "--watch", "--resume", "--pack", "--drop-cache"]
         # Stores the args that were provided
         self.args = {}
-        self.baseline_contents = {}
         self.source_contents = {}
         self.baseline_hashes = {}
+        self.baseline_sizes = set()
+        self.source_digests = {}
+        self.source_unchanged = None
+        self.source_moved = {}
+        self.manifest = None
+        self.journal = None
+        self.resume = False
+        self.compression = "none"
+        self.pool = None
+        self.jobs = 1
+        self.large_jobs = 2
+        self.algorithm = None
         self.src = ""
         self.dst = ""
         self.current_date = datetime.now()
         self.verbosity = 1
-        self.log_error = False
 
     # Get all the switches used in the command line
     def check_switches(self):
-        # The minimum arguments needed is 5. If there are less than 5, print the help text
-        if len(argv) < 5:
+        # The minimum arguments needed is 3 (-d and its value, plus one more switch).
+        # If there are less than 3, print the help text
+        if len(argv) < 3:
             print(self.helptxt)
             raise SystemExit
-        # Else if 5 or more args are provided, get the values of the args and continue
-        # Max number of args is 17, since q and v cannot be used together
-        elif len(argv) < 18:
+        # A command, if any, comes first and is followed by the switches as usual
+        start = 1
+        if argv[1] in self.commands:
+            self.command = argv[1]
+            start = 2
+        # Else if enough args are provided, get the values of the args and continue
+        # Max number of args is the program name, every switch with its value and every flag
+        if len(argv) <= start + 2 * (len(self.switches) + len(self.long_switches)) - len(self.flags):
             # Dictionary assigned with all args and their values
             count = 0
-            for i in range(1, len(argv)):
-                if "-" in argv[i] and len(argv[i]) == 2:
-                    if any(x in argv[i] for x in self.switches):
-                        if argv[i] == "-a":
-                            self.args[argv[i]] = True
-                            count += 1
-                        elif argv[i] == "-q":
+            for i in range(start, len(argv)):
+                if argv[i] in self.long_switches or ("-" in argv[i] and len(argv[i]) == 2):
+                    if argv[i] in self.long_switches or any(x in argv[i] for x in self.switches):
+                        if argv[i] in self.flags:
                             self.args[argv[i]] = True
-                            self.verbosity = 0
                             count += 1
-                        elif argv[i] == "-v":
-                            self.args[argv[i]] = True
-                            count += 1
-                            self.verbosity = 2
-                        else:
+                            if argv[i] == "-q":
+                                self.verbosity = 0
+                            elif argv[i] == "-v":
+                                self.verbosity = 2
+                        elif i + 1 < len(argv):
                             self.args[argv[i]] = argv[i + 1]
                     else:
                         print(f"Bad option {argv[i]}. Quitting")
                         raise SystemExit
+                elif argv[i].startswith("--"):
+                    print(f"Bad option {argv[i]}. Quitting")
+                    raise SystemExit
             # check if the args dictionary matches what was given in the command
             # Minus 1 because we don't count the name of the program, add the count value back for correct number
-            if len(self.args) * 2 != len(argv) - 1 + count:
+            if len(self.args) * 2 != len(argv) - start + count:
                 print("Malformed command. Possible spaces in source or destination paths. Use quotations around paths"
                       " if there are spaces.")
                 raise SystemExit
             # Check for required switches
-            # If a source directory is not specified
-            if "-s" not in self.args:
+            # If a source directory is not specified (rebuilding the index only needs the destination)
+            if "-s" not in self.args and "--rebuild-index" not in self.args and self.command is None:
                 # Print error and quit the program
                 print("Missing -s argument. Please use -s [source] in your command")
                 raise SystemExit
             # Else, a source directory is specified
-            else:
+            elif "-s" in self.args:
                 # Else, if the source directory does not include a forward slash at the end of the directory
                 if "/" not in list(self.args["-s"])[-1] and '\\' not in list(self.args["-s"])[-1]:
                     # Print error, but continue
@@ -160,12 +340,63 @@ class Cli:
             raise SystemExit
 
 
-def write_log(msg, path):
-    now = datetime.now()
-    write_now = f"{now.year}-{now.month}-{now.day} {now.hour}:{now.minute}:{now.second}"
-    outfile = open(path, "a")
-    outfile.write(f"{write_now} - {msg}\n")
-    outfile.close()
+class Logger:
+    """
+    Appends timestamped lines to a log file from a background thread. The file is opened once and written
+    through a buffer, and lines are handed over on a queue so verbose_print never waits on the disk.
+    Whatever is still queued is written out when the program exits.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "a", buffering=1024 * 1024)
+        self.queue = Queue()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, msg):
+        now = datetime.now()
+        write_now = f"{now.year}-{now.month}-{now.day} {now.hour}:{now.minute}:{now.second}"
+        self.queue.put(f"{write_now} - {msg}\n")
+
+    def run(self):
+        while True:
+            line = self.queue.get()
+            if line is None:
+                break
+            self.file.write(line)
+            # Only flush once the queue is drained, so bursts of lines go out in one write
+            if self.queue.empty():
+                self.file.flush()
+        self.file.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            self.file.close()
+
+
+# Open loggers by the path given to -l, so the path is only resolved once
+loggers = {}
+
+
+# Get the logger for a -l path, which is either a log file or a directory to write smartbackup.log in
+def get_logger(path):
+    if path not in loggers:
+        pth = Path(path)
+        # If a file is specified, write directly
+        if pth.is_file():
+            loggers[path] = Logger(path)
+        # If a directory is specified, write to a default file "smartbackup.log"
+        elif pth.is_dir():
+            loggers[path] = Logger(join(path, "smartbackup.log"))
+        # Path is not a directory nor a file, so it must not exist
+        else:
+            print("Error: Log path doesn't exist. Writing to script origin directory")
+            loggers[path] = Logger("smartbackup.log")
+            loggers[path].write("Error: Log path doesn't exist. Writing to script origin directory")
+    return loggers[path]
 
 
 def verbose_print(msg, level):
@@ -174,25 +405,7 @@ def verbose_print(msg, level):
         if cli.verbosity >= level:
             print(msg)
             if "-l" in cli.args:
-                # Check if a file is specified or a directory is specified
-                path = cli.args["-l"]
-                pth = Path(path)
-                # If a file is specified, write directly
-                if pth.is_file():
-                    write_log(msg, path)
-                # If a directory is specified, write to a default file "smartbackup.log"
-                elif pth.is_dir():
-                    if "\\" not in list(path)[-1] or "/" not in list(path)[-1]:
-                        path = path + slash
-                    write_log(msg, f"{path}smartbackup.log")
-                # Path is not a directory nor a file, so it must not exist
-                else:
-                    if not cli.log_error:
-                        print("Error: Log path doesn't exist. Writing to script origin directory")
-                        write_log("Error: Log path doesn't exist. "
-                                  "Writing to script origin directory", "smartbackup.log")
-                        cli.log_error = True
-                    write_log(msg, "smartbackup.log")
+                get_logger(cli.args["-l"]).write(msg)
             return
     except NameError:
         pass
@@ -204,38 +417,435 @@ def verbose_print(msg, level):
     #     pass
 
 
-# Get baseline of all contents in folder
-def get_baseline(folder):   # print("################ -o- ################")
-                        # print(cli.baseline_contents)
-                        # print("################ -o- ################")
+# Hidden folder in the destination that holds smartbackup's own bookkeeping
+META_DIR = ".smartbackup"
+MANIFEST_NAME = "manifest.db"
+MANIFEST_VERSION = 1
+
+
+class Manifest:
+    """
+    Persistent index of the files in the destination, stored as an SQLite database in META_DIR.
+    Records the size, mtime_ns and inode of every file along with its digest per hash algorithm,
+    so a run only has to hash the files that changed since the manifest last saw them.
+    """
+
+    def __init__(self, destination):
+        self.root = destination
+        try:
+            mkdir(join(destination, META_DIR))
+        except FileExistsError:
+            pass
+        self.db = sqlite3.connect(join(destination, META_DIR, MANIFEST_NAME))
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is not None and int(row[0]) != MANIFEST_VERSION:
+            verbose_print("Manifest was written by another version of smartbackup. Rebuilding it", 1)
+            self.db.execute("DROP TABLE IF EXISTS files")
+            self.db.execute("DROP TABLE IF EXISTS digests")
+            self.db.execute("DELETE FROM meta WHERE key = 'indexed'")
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(MANIFEST_VERSION),))
+        self.db.execute("CREATE TABLE IF NOT EXISTS files "
+                        "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS digests "
+                        "(path TEXT, algorithm TEXT, digest TEXT, PRIMARY KEY (path, algorithm))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS digests_by_digest ON digests (algorithm, digest)")
+        # Stat and digest of the source files as of the last run, keyed by absolute path
+        self.db.execute("CREATE TABLE IF NOT EXISTS sources "
+                        "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+                        "algorithm TEXT, digest TEXT)")
+        self.db.execute("CREATE TEMP TABLE seen (path TEXT PRIMARY KEY)")
+        self.db.commit()
+        self.pending = 0
+
+    def relative(self, path):
+        return relpath(path, self.root)
+
+    # Return the stored digest of a file, or None if the file changed since it was recorded
+    def lookup(self, path, st, algorithm):
+        path = self.relative(path)
+        self.db.execute("INSERT OR IGNORE INTO seen VALUES (?)", (path,))
+        row = self.db.execute("SELECT digest FROM files JOIN digests USING (path) "
+                              "WHERE path = ? AND algorithm = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                              (path, algorithm, st.st_size, st.st_mtime_ns, st.st_ino)).fetchone()
+        return row[0] if row else None
+
+    # Store the stat of a file, and its digest if known. Digests of a previous version of the file are dropped
+    def record(self, path, st, algorithm=None, digest=None):
+        path = self.relative(path)
+        row = self.db.execute("SELECT size, mtime_ns, inode FROM files WHERE path = ?", (path,)).fetchone()
+        if row != (st.st_size, st.st_mtime_ns, st.st_ino):
+            self.db.execute("DELETE FROM digests WHERE path = ?", (path,))
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                            (path, st.st_size, st.st_mtime_ns, st.st_ino))
+        if digest is not None:
+            self.db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?)", (path, algorithm, digest))
+        self.pending += 1
+        if self.pending >= 10000:
+            self.db.commit()
+            self.pending = 0
+
+    # Return the digest a source file had on the last run, or None if its stat changed since
+    def source_lookup(self, path, st, algorithm):
+        row = self.db.execute("SELECT digest FROM sources "
+                              "WHERE path = ? AND algorithm = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                              (abspath(path), algorithm, st.st_size, st.st_mtime_ns, st.st_ino)).fetchone()
+        return row[0] if row else None
+
+    def record_source(self, path, st, algorithm, digest):
+        self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)",
+                        (abspath(path), st.st_size, st.st_mtime_ns, st.st_ino, algorithm, digest))
+        self.pending += 1
+        if self.pending >= 10000:
+            self.db.commit()
+            self.pending = 0
+
+    # Pick the hash algorithm of this run and record it, so later runs compare like with like. Without one
+    # asked for, the algorithm the destination was backed up with is kept
+    def use_algorithm(self, algorithm=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'algorithm'").fetchone()
+        recorded = row[0] if row else None
+        if algorithm is None:
+            algorithm = recorded or DEFAULT_ALGORITHM
+        elif recorded is not None and algorithm != recorded:
+            verbose_print(f"Destination was backed up with {recorded}, switching to {algorithm}. "
+                          f"Every backed up file will be hashed again", 1)
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('algorithm', ?)", (algorithm,))
+        self.db.commit()
+        return algorithm
+
+    # Return the path of the most recently recorded file with this digest, or None if there is none
+    def path_for(self, digest, algorithm):
+        row = self.db.execute("SELECT path FROM digests WHERE algorithm = ? AND digest = ? ORDER BY rowid DESC LIMIT 1",
+                              (algorithm, digest)).fetchone()
+        return join(self.root, row[0]) if row else None
+
+    # Every file recorded with a digest for algorithm, as (path, size, digest)
+    def entries(self, algorithm):
+        return self.db.execute("SELECT path, size, digest FROM files JOIN digests USING (path) WHERE algorithm = ?",
+                               (algorithm,)).fetchall()
+
+    # Whether a walk of the whole destination filled the manifest with digests for algorithm
+    def indexed(self, algorithm):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'indexed'").fetchone()
+        return row is not None and row[0] == algorithm
+
+    def set_indexed(self, algorithm):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('indexed', ?)", (algorithm,))
+        self.db.commit()
+
+    # Forget files at paths relative to the destination
+    def forget(self, paths):
+        self.db.executemany("DELETE FROM digests WHERE path = ?", ((path,) for path in paths))
+        self.db.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in paths))
+        self.db.commit()
+
+    # Forget every file that was not looked up since the manifest was opened, they are gone from the destination.
+    # With folder, a path relative to the destination, only files under folder are forgotten
+    def prune(self, folder=None):
+        if folder is None:
+            self.db.execute("DELETE FROM digests WHERE path NOT IN (SELECT path FROM seen)")
+            self.db.execute("DELETE FROM files WHERE path NOT IN (SELECT path FROM seen)")
+        else:
+            # Paths under folder sort between folder/ and the character after the separator
+            bounds = (folder + sep, folder + chr(ord(sep) + 1))
+            self.db.execute("DELETE FROM digests WHERE path >= ? AND path < ? AND path NOT IN (SELECT path FROM seen)",
+                            bounds)
+            self.db.execute("DELETE FROM files WHERE path >= ? AND path < ? AND path NOT IN (SELECT path FROM seen)",
+                            bounds)
+        self.db.commit()
+
+    def clear(self):
+        self.db.execute("DELETE FROM digests")
+        self.db.execute("DELETE FROM files")
+        self.db.execute("DELETE FROM meta WHERE key = 'indexed'")
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+JOURNAL_NAME = "journal.jsonl"
+# Name copy_file gives a file while copying it: the final name followed by .PID.tmp
+TEMP_NAME = re.compile(r"\.\d+\.tmp$")
+# Journal entries written between two syncs of the journal to disk
+JOURNAL_SYNC = 1000
+
+
+class Journal:
+    """
+    Write-ahead journal of the backup in progress, stored as JSON lines in META_DIR. Names the backup folder, then
+    lists every folder and file of it as they are done, so an interrupted backup can be finished with --resume.
+    Removed once the backup is complete.
+    """
+
+    def __init__(self, destination):
+        self.root = destination
+        makedirs(join(destination, META_DIR), exist_ok=True)
+        self.path = join(destination, META_DIR, JOURNAL_NAME)
+        # Name of the backup folder being written, None if no backup was interrupted
+        self.folder = None
+        self.dirs = set()
+        self.files = set()
+        # Processes that wrote to the folder, to find their temporary files
+        self.pids = []
+        self.out = None
+        self.unsynced = 0
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a run that was killed while writing it
+                        break
+                    if "folder" in entry:
+                        self.folder = entry["folder"]
+                    elif "pid" in entry:
+                        self.pids.append(entry["pid"])
+                    elif "dir" in entry:
+                        self.dirs.add(entry["dir"])
+                    elif "file" in entry:
+                        self.files.add(entry["file"])
+        except FileNotFoundError:
+            pass
+
+    # Start journaling the backup into folder. Unless resuming that same folder, what the journal held is dropped
+    def begin(self, folder, resume=False):
+        if not resume or folder != self.folder:
+            temp = f"{self.path}.{getpid()}.tmp"
+            with open(temp, "w", encoding="utf-8") as out:
+                out.write(json.dumps({"folder": folder, "started": datetime.now().isoformat()}) + "\n")
+            replace(temp, self.path)
+            self.folder = folder
+            self.dirs.clear()
+            self.files.clear()
+            self.pids = []
+        self.out = open(self.path, "a", encoding="utf-8")
+        self.write({"pid": getpid()})
+
+    def write(self, entry):
+        self.out.write(json.dumps(entry) + "\n")
+        self.out.flush()
+        self.unsynced += 1
+        if self.unsynced >= JOURNAL_SYNC:
+            fsync(self.out.fileno())
+            self.unsynced = 0
+
+    def dir(self, path):
+        if path not in self.dirs:
+            self.dirs.add(path)
+            self.write({"dir": path})
+
+    def file(self, path):
+        self.files.add(path)
+        self.write({"file": path})
+
+    # Remove the temporary files that copies cut short left in the backup folder
+    def clean(self):
+        endings = tuple(f".{pid}.tmp" for pid in self.pids)
+        if not endings:
+            return
+        for key, files in scan_tree(join(self.root, self.folder)):
+            for file, st in files:
+                if file.endswith(endings):
+                    verbose_print(f"Removing unfinished copy {key}{slash}{file}", 2)
+                    remove(key + slash + file)
+
+    # The backup is complete, there is nothing left to resume
+    def finish(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        remove(self.path)
+        self.folder = None
+
+
+# Walk folder one directory at a time, without recursion. Yields (dirpath, [(file, stat)]) for every directory,
+# parents before their children, with the stat cached by scandir. Names in skip are left out of the top folder only
+def scan_tree(folder, skip=()):
+    stack = [(folder, skip)]
+    while stack:
+        dirpath, skipped = stack.pop()
+        files = []
+        dirs = []
+        try:
+            with scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            if entry.name not in skipped:
+                                dirs.append(dirpath + slash + entry.name)
+                        else:
+                            files.append((entry.name, entry.stat()))
+                    except OSError:
+                        verbose_print(f"OS Error for {dirpath}{slash}{entry.name}: skipping", 1)
+        except FileNotFoundError:
+            # The folder itself doesn't exist, there is nothing to walk
+            continue
+        except OSError:
+            verbose_print(f"OS Error for {dirpath}: skipping", 1)
+            continue
+        yield dirpath, files
+        # Reversed so the first subdirectory is walked first, like a recursive walk would
+        for d in reversed(dirs):
+            stack.append((d, ()))
+
+
+# Get baseline of all contents in folder. Names in skip are left out of the top folder only
+def get_baseline(folder, skip=()):
     temp_baseline = {}
-    dir_list = []
-    for (dirpath, dirnames, filenames) in walk(folder):
-        temp = []
-        for dirs in dirnames:
-            # Don't need to append dirs to the list since the recursive get already does that
-            dir_list.append(dirs)
-        for file in filenames:
-            temp.append(file)
-        temp_baseline[folder] = temp
-        break
-    # Recursion
-    if len(dir_list) > 0:
-        for d in dir_list:
-            temp_baseline.update(get_baseline(folder + slash + d))
+    for dirpath, files in scan_tree(folder, skip):
+        temp_baseline[dirpath] = [file for file, st in files]
     return temp_baseline
 
 
-def get_hash_type(algorithm="sha1"):
-    algorithm = algorithm.strip().lower()
-    for alg in hashlib.algorithms_guaranteed:
-        if algorithm == alg:
-            algorithm = eval(compile(f"hashlib.{algorithm}()", '<string>', 'eval'))
-            return algorithm
-    else:
-        verbose_print(f"Error: Invalid hash algorithm type: {algorithm}. Defaulting to sha1", 1)
-        algorithm = hashlib.sha1()
-        return algorithm
+# Hash algorithm used when neither -h nor the manifest of the destination says otherwise
+DEFAULT_ALGORITHM = "blake2b"
+# Bytes read from a file per step when hashing it, set with --buffer-size
+read_size = 65536
+
+
+def set_read_size(size):
+    global read_size
+    read_size = size
+
+
+class Throttle:
+    """
+    Token buckets for bytes read, bytes written and I/O operations, shared by every thread of the process. Up to a
+    second worth of each can be used at once, then a thread that goes over a limit sleeps until the bucket refills.
+    """
+
+    def __init__(self, read_rate=None, write_rate=None, iops=None):
+        self.rates = {"read": read_rate, "write": write_rate, "ops": iops}
+        self.tokens = {kind: rate or 0 for kind, rate in self.rates.items()}
+        self.last = monotonic()
+        self.lock = Lock()
+
+    # Count size bytes of kind ("read" or "write") in one operation, and wait if that went over a limit
+    def take(self, kind, size):
+        with self.lock:
+            now = monotonic()
+            elapsed = now - self.last
+            self.last = now
+            for bucket, rate in self.rates.items():
+                if rate:
+                    self.tokens[bucket] = min(rate, self.tokens[bucket] + elapsed * rate)
+            wait = 0
+            for bucket, used in ((kind, size), ("ops", 1)):
+                rate = self.rates[bucket]
+                if rate:
+                    self.tokens[bucket] -= used
+                    wait = max(wait, -self.tokens[bucket] / rate)
+        if wait > 0:
+            sleep(wait)
+
+
+# Limits of --bwlimit and --iops, None when there are none, and whether to drop read files from the page cache
+throttle = None
+io_limits = (None, None, None, False)
+drop_cache = False
+
+
+def configure_io(read_rate=None, write_rate=None, iops=None, drop=False):
+    global throttle, io_limits, drop_cache
+    io_limits = (read_rate, write_rate, iops, drop)
+    throttle = Throttle(read_rate, write_rate, iops) if read_rate or write_rate or iops else None
+    drop_cache = drop
+
+
+# Set up a worker process of a HashPool. Every worker gets its share of the limits of the whole run
+def start_worker(size, limits, workers):
+    set_read_size(size)
+    configure_io(*[limit / workers if limit else limit for limit in limits[:3]], limits[3])
+
+
+# Count size bytes read or written against the --bwlimit and --iops limits, waiting if that went over them
+def account(kind, size):
+    if throttle is not None:
+        throttle.take(kind, size)
+
+
+# With --drop-cache, tell the kernel an open file won't be needed again, so backups don't push the files other
+# programs use out of the page cache. The kernel keeps pages not yet on disk, so a written file is flushed first
+def forget(f, written=False):
+    if drop_cache and posix_fadvise is not None:
+        try:
+            if written:
+                f.flush()
+                fdatasync(f.fileno())
+            posix_fadvise(f.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+# ioprio_set syscall number by machine, and the I/O scheduling classes of --ionice
+IOPRIO_SYSCALLS = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "arm64": 30, "armv7l": 314,
+                   "ppc64le": 273, "s390x": 282}
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+# Whether set_priority already ran in this process
+priority_set = False
+
+
+# Lower the CPU priority of the process by nice_value and set its I/O priority, like idle or best-effort:7.
+# Threads and processes started afterwards inherit both
+def set_priority(nice_value=None, ionice=None):
+    global priority_set
+    # nice adds to the current niceness, and the main loop parses the switches again on every pass
+    if priority_set:
+        return
+    priority_set = True
+    if nice_value is not None and nice is not None:
+        nice(nice_value)
+    if ionice is None:
+        return
+    name, _, level = ionice.partition(":")
+    if platf != "Linux" or machine() not in IOPRIO_SYSCALLS:
+        verbose_print("--ionice is only supported on Linux, ignoring it", 1)
+        return
+    # Priority levels go from 0 (highest) to 7, the idle class has none
+    priority = IOPRIO_CLASSES[name] << 13 | int(level or (0 if name == "idle" else 4))
+    libc = CDLL(find_library("c"), use_errno=True)
+    # IOPRIO_WHO_PROCESS, for the calling thread
+    if libc.syscall(IOPRIO_SYSCALLS[machine()], 1, 0, priority) < 0:
+        verbose_print(f"Could not set the I/O priority: {strerror(get_errno())}", 1)
+
+
+# Check a -h value and return it in canonical form: the name of a hashlib algorithm, followed for blake2b and
+# blake2s by -N to pick a digest of N bytes instead of the largest one. Raises ValueError for anything else
+def parse_algorithm(algorithm):
+    name, _, size = algorithm.strip().lower().partition("-")
+    # shake algorithms need a length for every digest, they don't fit
+    if name not in hashlib.algorithms_guaranteed or name.startswith("shake"):
+        raise ValueError(f"Invalid hash algorithm type: {algorithm}")
+    if not size:
+        return name
+    if name not in ("blake2b", "blake2s") or not 1 <= int(size) <= getattr(hashlib, name).MAX_DIGEST_SIZE:
+        raise ValueError(f"Invalid digest size for {name}: {size}")
+    if int(size) == getattr(hashlib, name).MAX_DIGEST_SIZE:
+        return name
+    return f"{name}-{int(size)}"
+
+
+# Get the constructor of hashers for an algorithm as returned by parse_algorithm, resolved once per algorithm
+@lru_cache(maxsize=None)
+def get_hasher(algorithm="sha1"):
+    name, _, size = algorithm.partition("-")
+    if size:
+        return partial(getattr(hashlib, name), digest_size=int(size))
+    return getattr(hashlib, name)
+
+
+# Get a number of bytes from a size like 65536, 64K, 1M or 2G
+def parse_size(size):
+    size = size.strip().upper()
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
 
 
 def get_len(array):
@@ -245,81 +855,381 @@ def get_len(array):
     return length
 
 
-def get_hashes(contents, algorithm="sha1"):
-    hashes = []
-    ln = get_len(contents)
-    progress = 0
-    # printprogressbar(0, ln, prefix='Progress:', suffix='Complete', length=50)
-    for key in contents:
-        for thing in contents[key]:
-            file = key + slash + thing
-            verbose_print("Hashing " + file, 2)
-            hsh = get_hash_type(algorithm)
-            try:
-                with open(file, "rb") as f:
-                    while True:
-                        data = f.read(65536)
-                        if not data:
-                            break
-                        hsh.update(data)
-                digest = hsh.hexdigest()
-                if digest not in hashes:
-                    hashes.append(digest)
-            except UnicodeDecodeError:
-                verbose_print(f"Cannot decode {file}: skipping", 1)
-            except PermissionError:
-                verbose_print(f"Permission Error for file {file}: skipping", 1)
-            except OSError:
-                verbose_print(f"OS Error for {file}: skipping", 1)
-            # printprogressbar(progress + 1, ln, prefix='Progress:', suffix='Complete', length=50)
-            progress += 1
-    return frozenset(hashes)
+# Read a file through the hash algorithm. Returns the hex digest and None, or None and the error that stopped it
+def hash_file(file, algorithm="sha1"):
+    hsh = get_hasher(algorithm)()
+    buffer = bytearray(read_size)
+    view = memoryview(buffer)
+    try:
+        with open(file, "rb") as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                account("read", n)
+                hsh.update(view[:n])
+            forget(f)
+        return hsh.hexdigest(), None
+    except (UnicodeDecodeError, OSError) as error:
+        return None, error
+
+
+# Report a file that could not be hashed. The file is skipped
+def hash_error(file, error):
+    if isinstance(error, UnicodeDecodeError):
+        verbose_print(f"Cannot decode {file}: skipping", 1)
+    elif isinstance(error, PermissionError):
+        verbose_print(f"Permission Error for file {file}: skipping", 1)
+    else:
+        verbose_print(f"OS Error for {file}: skipping", 1)
+
+
+class HashPool:
+    """
+    Runs hash_file over many files on a pool of worker threads, or worker processes for trees of small files
+    where the interpreter rather than the disk is the bottleneck. Results come back in the order the files
+    were given, and at most a few files per worker are in flight so the file list can be a generator.
+    With a single job, files are hashed in the calling thread. Any other work(file, algorithm) function that
+    returns a (result, error) pair the same way can be run instead of hash_file.
+    """
+
+    def __init__(self, jobs=1, processes=False):
+        self.jobs = max(1, jobs)
+        self.window = self.jobs * 4
+        self.executor = None
+        if self.jobs > 1 and processes:
+            # Worker processes don't share read_size or the I/O limits, hand them over when they start
+            self.executor = ProcessPoolExecutor(self.jobs, initializer=start_worker,
+                                                initargs=(read_size, io_limits, self.jobs))
+        elif self.jobs > 1:
+            self.executor = ThreadPoolExecutor(self.jobs)
+
+    # Yield (item, (digest, error)) for every item. file picks the path to hash out of an item
+    def imap(self, items, algorithm="sha1", file=lambda item: item, work=hash_file):
+        if self.executor is None:
+            for item in items:
+                yield item, work(file(item), algorithm)
+            return
+        in_flight = deque()
+        for item in items:
+            in_flight.append((item, self.executor.submit(work, file(item), algorithm)))
+            if len(in_flight) >= self.window:
+                item, future = in_flight.popleft()
+                yield item, future.result()
+        while in_flight:
+            item, future = in_flight.popleft()
+            yield item, future.result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class DigestIndex:
+    """
+    Digests of the files in the destination, kept as binary digests mapped to (path relative to the destination,
+    size). Tells whether a digest is backed up, and where, in constant time.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        # Further (path, size) of digests found in more than one file, which is rare
+        self.duplicates = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, digest):
+        return bytes.fromhex(digest) in self.entries
+
+    def add(self, digest, path, size):
+        key = bytes.fromhex(digest)
+        first = self.entries.setdefault(key, (path, size))
+        if first[0] != path:
+            self.duplicates.setdefault(key, []).append((path, size))
+
+    # Forget that digest is at path, when the file there gets replaced
+    def discard(self, digest, path):
+        key = bytes.fromhex(digest)
+        others = self.duplicates.get(key, [])
+        if key in self.entries and self.entries[key][0] == path:
+            if others:
+                self.entries[key] = others.pop(0)
+            else:
+                del self.entries[key]
+        else:
+            others[:] = [entry for entry in others if entry[0] != path]
+        if key in self.duplicates and not others:
+            del self.duplicates[key]
+
+    # Return every (path, size) holding digest
+    def get(self, digest):
+        key = bytes.fromhex(digest)
+        if key not in self.entries:
+            return []
+        return [self.entries[key]] + self.duplicates.get(key, [])
+
+    # Return None if digest is backed up at path inside any backup folder, else one path it is backed up at
+    def moved_from(self, digest, path):
+        entries = self.get(digest)
+        for backed_up, size in entries:
+            # Backed up paths start with the backup folder, like 2024-1-31.1/
+            if backed_up.partition(sep)[2] == path:
+                return None
+        return entries[0][0] if entries else None
+
+
+# Hash every file of a scan_tree walk of root into index, a new DigestIndex by default. With a manifest, files it
+# already knows are not read again. The size of every file is added to sizes
+def get_hashes(tree, algorithm="sha1", manifest=None, pool=None, sizes=None, root="", index=None):
+    index = index if index is not None else DigestIndex()
+    pool = pool or HashPool()
+    progress = Progress("Hashing destination:")
+
+    # Files the manifest can't vouch for, with their stat
+    def unknown():
+        for key, files in tree:
+            for thing, st in files:
+                # Left by a copy that was cut short, it isn't a backed up file
+                if TEMP_NAME.search(thing):
+                    continue
+                file = key + slash + thing
+                if sizes is not None:
+                    sizes.add(st.st_size)
+                digest = manifest.lookup(file, st, algorithm) if manifest is not None else None
+                if digest is None:
+                    verbose_print("Hashing " + file, 2)
+                    yield file, st
+                else:
+                    index.add(digest, relpath(file, root), st.st_size)
+                    progress.update()
+
+    for (file, st), (digest, error) in pool.imap(unknown(), algorithm, lambda item: item[0]):
+        progress.update(size=st.st_size)
+        if error is not None:
+            hash_error(file, error)
+            continue
+        if manifest is not None:
+            manifest.record(file, st, algorithm, digest)
+        index.add(digest, relpath(file, root), st.st_size)
+    progress.done()
+    return index
 
 
-def compare_hashes(folder, baseline_hashes, algorithm="sha1"):
-    num_dirs = []
+# Get a DigestIndex of the backups in destination. Backup folders are read from the manifest in one query, except the
+# newest one, which --watch and --resume can still add files to and which is checked by stat like get_hashes does.
+# The whole destination is walked with full, or while the manifest was never filled by a walk with algorithm
+def destination_hashes(destination, algorithm, manifest, pool=None, sizes=None, full=False):
+    if full or not manifest.indexed(algorithm):
+        index = get_hashes(scan_tree(destination, (META_DIR,)), algorithm, manifest, pool, sizes, destination)
+        manifest.prune()
+        manifest.set_indexed(algorithm)
+        return index
+    present = {entry.name for entry in scandir(destination) if entry.name != META_DIR}
+    folders = [name for name in present if backup_key(name)]
+    newest = max(folders, key=backup_key) if folders else None
+    index = DigestIndex()
+    gone = []
+    for path, size, digest in manifest.entries(algorithm):
+        top = path.split(sep, 1)[0]
+        if top not in present:
+            gone.append(path)
+        elif top != newest:
+            index.add(digest, path, size)
+            if sizes is not None:
+                sizes.add(size)
+    # Backup folders deleted since the last run, as when old backups are rotated out
+    if gone:
+        manifest.forget(gone)
+    if newest is not None:
+        get_hashes(scan_tree(join(destination, newest)), algorithm, manifest, pool, sizes, destination, index)
+        manifest.prune(newest)
+    return index
+
+
+# Get the files of folder whose hash is not in baseline_hashes, a DigestIndex. The digests of those files are stored
+# in digests and the files whose hash is in baseline_hashes are stored in unchanged as {dir: [(file, digest)]}
+# Files backed up under another path only, as after a rename or a move, are also stored in moved the same way
+# With a tree, as scan_tree would yield it, only the files of tree are compared instead of all of folder
+# With a manifest and unless paranoid, files whose stat is unchanged since the last run are not hashed again
+# Files whose size is not in baseline_sizes are new for sure. They are not hashed and get no entry in digests
+def compare_hashes(folder, baseline_hashes, algorithm="sha1", digests=None, manifest=None, paranoid=False,
+                   pool=None, unchanged=None, baseline_sizes=None, moved=None, tree=None):
     contents = {}
-    for (dirpath, dirnames, filenames) in walk(folder):
-        temp = []
-        for dirs in dirnames:
-            num_dirs.append(dirs)
-        for file in filenames:
-            rf = folder + slash + file
-            hsh = get_hash_type(algorithm)
+    pool = pool or HashPool()
+    progress = Progress("Hashing source:")
+
+    # Files whose digest isn't known from the last run, with their stat
+    def unknown():
+        for key, files in (tree if tree is not None else scan_tree(folder)):
+            # Every dir is kept, even without changed files, so the whole tree gets recreated
+            contents[key] = []
+            for file, st in files:
+                rf = key + slash + file
+                digest = None
+                if manifest is not None and not paranoid:
+                    digest = manifest.source_lookup(rf, st, algorithm)
+                if digest is None and baseline_sizes is not None and st.st_size not in baseline_sizes:
+                    # Nothing in the destination has this size, the file gets hashed while it is copied
+                    verbose_print(f"New size found for file {str(file)}", 1)
+                    contents[key].append(file)
+                    progress.update()
+                elif digest is None:
+                    yield key, file, st
+                else:
+                    check(key, file, digest)
+                    progress.update()
+
+    def check(key, file, digest):
+        if digest not in baseline_hashes:
+            verbose_print(f"New Hash found for file {str(file)}", 1)
+            contents[key].append(file)
+            if digests is not None:
+                digests[key + slash + file] = digest
+            return
+        previous = baseline_hashes.moved_from(digest, relpath(key + slash + file, folder))
+        if previous is not None:
+            verbose_print(f"Moved file found: {str(file)}, backed up as {previous}", 1)
+            if moved is not None:
+                moved.setdefault(key, []).append((file, digest))
+        if unchanged is not None:
+            unchanged.setdefault(key, []).append((file, digest))
+
+    for (key, file, st), (digest, error) in pool.imap(unknown(), algorithm, lambda item: item[0] + slash + item[1]):
+        progress.update(size=st.st_size)
+        if error is not None:
+            hash_error(key + slash + file, error)
+            continue
+        if manifest is not None:
+            manifest.record_source(key + slash + file, st, algorithm, digest)
+        check(key, file, digest)
+    progress.done()
+    return contents
+
+
+# ioctl request that makes a file share the data blocks of another (Btrfs, XFS, OCFS2...)
+FICLONE = 0x40049409
+# Files of at least this size count as large when copying
+LARGE_FILE_SIZE = 16 * 1024 * 1024
+
+
+# Bytes handed to the kernel, or read and hashed, per step of a copy
+COPY_BUFFER = 1024 * 1024
+
+
+# Copy the data of the open file src to dst inside the kernel where the platform allows it: copy_file_range
+# (which can also reflink or copy server side on NFS and CIFS), then sendfile, then a plain buffered copy
+def copy_data(src, dst):
+    for kernel_copy in (copy_file_range, sendfile):
+        if kernel_copy is None:
+            continue
+        copied = 0
+        try:
+            while True:
+                if kernel_copy is sendfile:
+                    n = sendfile(dst.fileno(), src.fileno(), copied, COPY_BUFFER)
+                else:
+                    n = copy_file_range(src.fileno(), dst.fileno(), COPY_BUFFER)
+                if n == 0:
+                    return
+                account("read", n)
+                account("write", n)
+                copied += n
+        except OSError:
+            # Only give up on the kernel path if it failed straight away, like between filesystems
+            if copied:
+                raise
+    if throttle is None:
+        copyfileobj(src, dst, COPY_BUFFER)
+        return
+    while True:
+        data = src.read(COPY_BUFFER)
+        if not data:
+            return
+        account("read", len(data))
+        dst.write(data)
+        account("write", len(data))
+
+
+# Copy the data of the open file src to dst, hashing it on the way. Returns the hex digest
+def copy_hashing(src, dst, algorithm="sha1"):
+    hsh = get_hasher(algorithm)()
+    buffer = bytearray(COPY_BUFFER)
+    view = memoryview(buffer)
+    while True:
+        n = src.readinto(buffer)
+        if not n:
+            return hsh.hexdigest()
+        account("read", n)
+        hsh.update(view[:n])
+        dst.write(view[:n])
+        account("write", n)
+
+
+# Copy a single file to target, with its metadata like copy2. With an algorithm, the file is hashed as it is
+# copied so it is only read once, else its data is copied by the kernel. Returns (target, digest or None,
+# stat of file) and None, or None and the error that stopped it
+def copy_file(file, target, algorithm=None):
+    # Written under a temporary name then renamed, so a file found at target is always complete
+    temp = f"{target}.{getpid()}.tmp"
+    try:
+        with open(file, "rb") as src, open(temp, "wb") as dst:
+            st = fstat(src.fileno())
+            if algorithm is not None:
+                digest = copy_hashing(src, dst, algorithm)
+            else:
+                digest = None
+                copy_data(src, dst)
+            forget(src)
+            forget(dst, True)
+        copystat(file, temp)
+        replace(temp, target)
+        return (target, digest, st), None
+    except (UnicodeDecodeError, OSError) as error:
+        try:
+            remove(temp)
+        except OSError:
+            pass
+        return None, error
+
+
+# Give target the contents of existing without copying any data. Uses a reflink where asked and the filesystem
+# supports it, else a hardlink. Returns the path of target and None, or None and the error that stopped it
+def link_file(existing, target, reflink=False):
+    if reflink and ioctl is not None:
+        try:
+            with open(existing, "rb") as src, open(target, "wb") as dst:
+                ioctl(dst.fileno(), FICLONE, src.fileno())
+            copystat(existing, target)
+            return target, None
+        except OSError:
             try:
-                with open(rf, "rb") as f:
-                    while True:
-                        data = f.read(65536)
-                        if not data:
-                            break
-                        hsh.update(data)
-                if hsh.hexdigest() not in baseline_hashes:
-                    verbose_print(f"New Hash found for file {str(file)}", 1)
-                    temp.append(file)
-            except UnicodeDecodeError:
-                verbose_print(f"Cannot decode {rf}: skipping", 1)
-            except PermissionError:
-                verbose_print(f"Permission error for {rf}: skipping", 1)
+                remove(target)
             except OSError:
-                verbose_print(f"OS Error for {rf}: skipping", 1)
-        # Hiding this part because it needs to create all the dirs and not just dirs that have contents
-        # if len(temp) > 0:
-        #    contents[folder] = temp
-        contents[folder] = temp
-        break
-    if len(num_dirs) > 0:
-        for d in num_dirs:
-            contents.update(compare_hashes(folder + slash + d, baseline_hashes))
-    return contents
+                pass
+    try:
+        link(existing, target)
+        return target, None
+    except OSError as error:
+        return None, error
 
 
-def copyfiles(contents, source, destination):
-    length = get_len(contents)
-    progress = 0
+# Copy contents into destination. Landed files are added to the manifest with their digest. Files whose digest
+# is not in digests are hashed while they are copied
+# Copies run on jobs threads, with up to twice as many small files and at most large_jobs large files in flight
+# Files in unchanged, as returned by compare_hashes, are linked from an earlier backup so destination is complete
+# With append, files are added to destination even if it exists, replacing the ones already there. The digests of
+# landed files are then added to index, a DigestIndex
+# With a journal, every folder and file is recorded in it once done, and files it already lists are skipped
+def copyfiles(contents, source, destination, manifest=None, digests=None, algorithm="sha1", jobs=1, large_jobs=2,
+              unchanged=None, reflink=False, append=False, index=None, journal=None):
     try:
         # Create the main backup folder
         verbose_print(f"Création du dossier {destination}", 1)
-        mkdir(destination)
+        if append:
+            makedirs(destination, exist_ok=True)
+        else:
+            mkdir(destination)
     except FileNotFoundError:
         print(f"Error, could not make directory {destination}. "
               f"Path may be wrong. Make sure your destination already exists")
@@ -327,31 +1237,1161 @@ def copyfiles(contents, source, destination):
     except FileExistsError:
         verbose_print("Sauvegarde existant de la journée. Création d'une nouvelle sauvegarde", 1)
         dest_n = str(int(destination.split(".")[-1]) + 1)
-        copyfiles(contents, source, destination.split(".")[0]+"."+dest_n)
+        copyfiles(contents, source, destination.split(".")[0]+"."+dest_n, manifest, digests, algorithm, jobs,
+                  large_jobs, unchanged, reflink, append, index, journal)
         return
-    printprogressbar(0, length, prefix='Progression:', suffix='Complete', length=50)
+    if journal is not None:
+        # Starts the journal over unless this is the folder the journal was left at
+        journal.begin(destination.rstrip("/\\").split(slash)[-1], append)
+    if journal is not None and journal.files:
+        # Resuming: what the interrupted run finished is left as it is
+        contents = {key: [file for file in files if relpath(key + slash + file, source) not in journal.files]
+                    for key, files in contents.items()}
+        if unchanged is not None:
+            unchanged = {key: [(file, digest) for file, digest in files
+                               if relpath(key + slash + file, source) not in journal.files]
+                         for key, files in unchanged.items()}
+    length = get_len(contents) + (get_len(unchanged) if unchanged is not None else 0)
+    # Recreate the whole tree first, so copies never wait on a folder
     for key in contents:
         source_replaced = key.replace(source, "")
         try:
             verbose_print(f"Création du dossier {destination}{slash}{source_replaced}", 1)
-            mkdir(destination + slash + source_replaced)
+            if append:
+                makedirs(destination + slash + source_replaced, exist_ok=True)
+            else:
+                mkdir(destination + slash + source_replaced)
         except FileNotFoundError:
             pass
             verbose_print(f"Error, could not make directory {destination}{slash}{source_replaced}", 1)
         except FileExistsError:
             pass
             verbose_print(f"Erreur: Fichier existant: {destination}{slash}{source_replaced}", 1)
+        if journal is not None:
+            journal.dir(relpath(key, source))
+    # Only the copies count towards the bytes to go, links don't move any data
+    length_bytes = 0
+    for key in contents:
         for file in contents[key]:
             try:
+                length_bytes += stat(key + slash + file).st_size
+            except OSError:
+                pass
+    progress = Progress("Copying:", length, length_bytes)
+
+    # Get target ready to be written. A file already there may be hardlinked from other backups, so it is removed
+    # rather than written over, and index forgets it
+    def target_for(key, file):
+        target = destination + slash + key.replace(source, "") + slash + file
+        if not append:
+            return target
+        try:
+            st = stat(target)
+        except OSError:
+            return target
+        old = manifest.lookup(target, st, algorithm) if manifest is not None else None
+        if old is not None and index is not None:
+            index.discard(old, manifest.relative(target))
+        try:
+            remove(target)
+        except OSError:
+            pass
+        return target
+
+    # Hash while copying only when the digest isn't known yet and there is a manifest to keep it in
+    def hash_with(key, file):
+        if manifest is None or (digests is not None and key + slash + file in digests):
+            return None
+        return algorithm
+
+    # Record a copied file, or report why it could not be copied
+    def landed(key, file, result, digest=None):
+        copied, error = result
+        source_replaced = key.replace(source, "")
+        if isinstance(error, PermissionError):
+            verbose_print(f"Permission Error copying {file}", 1)
+        elif error is not None:
+            verbose_print(f"Invalid argument: {destination}{slash}{source_replaced}, "
+                          f"possibly file of zero size. Skipping.", 1)
+        elif manifest is not None:
+            path, copied_digest, st = copied
+            if digest is None and digests is not None:
+                digest = digests.get(key + slash + file)
+            if digest is None and copied_digest is not None:
+                digest = copied_digest
+                # The source was hashed while it was copied, so the next run doesn't have to
+                manifest.record_source(key + slash + file, st, algorithm, digest)
+            manifest.record(path, stat(path), algorithm if digest else None, digest)
+            if index is not None and digest is not None:
+                index.add(digest, manifest.relative(path), stat(path).st_size)
+        if journal is not None and error is None:
+            journal.file(relpath(key + slash + file, source))
+        progress.update(size=copied[2].st_size if copied is not None and copied[2] is not None else 0)
+
+    # Files that didn't change are linked from an earlier backup, or copied if that backup can't be linked
+    if unchanged is not None:
+        for key in unchanged:
+            for file, digest in unchanged[key]:
+                existing = manifest.path_for(digest, algorithm) if manifest is not None else None
+                target = target_for(key, file)
+                path = None
+                if existing is not None:
+                    verbose_print(f"En cours de liaison {file}", 2)
+                    path, error = link_file(existing, target, reflink)
+                if path is not None:
+                    landed(key, file, ((path, None, None), None), digest)
+                else:
+                    verbose_print(f"En cours de copie {file}", 2)
+                    landed(key, file, copy_file(key + slash + file, target), digest)
+
+    if jobs <= 1:
+        for key in contents:
+            for file in contents[key]:
+                verbose_print(f"En cours de copie {file}", 2)
+                landed(key, file, copy_file(key + slash + file, target_for(key, file), hash_with(key, file)))
+        progress.done()
+        if journal is not None:
+            journal.finish()
+        return
+    small, large = {}, {}
+
+    # Wait for at least one copy to finish and take care of every finished one
+    def drain():
+        done, _ = wait(list(small) + list(large), return_when=FIRST_COMPLETED)
+        for future in done:
+            key, file = small.pop(future, None) or large.pop(future)
+            landed(key, file, future.result())
+
+    with ThreadPoolExecutor(jobs) as executor:
+        for key in contents:
+            for file in contents[key]:
+                try:
+                    in_flight = large if stat(key + slash + file).st_size >= LARGE_FILE_SIZE else small
+                except OSError:
+                    in_flight = small
+                while len(in_flight) >= (2 * jobs if in_flight is small else max(1, large_jobs)):
+                    drain()
                 verbose_print(f"En cours de copie {file}", 2)
-                copy2(key + slash + file, destination + slash + source_replaced)
-            except PermissionError:
-                verbose_print(f"Permission Error copying {file}", 1)
+                future = executor.submit(copy_file, key + slash + file, target_for(key, file),
+                                         hash_with(key, file))
+                in_flight[future] = (key, file)
+        while small or large:
+            drain()
+    progress.done()
+    if journal is not None:
+        journal.finish()
+
+
+# Content-defined chunking. A chunk ends where the rolling gear hash of its last bytes matches a mask, so an
+# insert or delete in a file only changes the chunks around it. Sizes are in bytes
+CHUNK_MIN = 512 * 1024
+CHUNK_AVG = 1024 * 1024
+CHUNK_MAX = 8 * 1024 * 1024
+# Seconds an incremental --chunked run waits after a pass that found no changes
+CHUNK_POLL = 5
+# Chunks are named after their digest, which has to stay the same whatever -h a run uses
+CHUNK_ALGORITHM = "sha256"
+# FastCDC normalized chunking: a harder mask before the average size and an easier one after it
+CHUNK_MASK_HARD = ((1 << 22) - 1) << 42
+CHUNK_MASK_EASY = ((1 << 18) - 1) << 46
+# Fixed random value per byte, seeded so every run and every machine cuts files at the same places
+_gear_random = Random(0x5B5B)
+CHUNK_GEAR = [_gear_random.getrandbits(64) for _ in range(256)]
+# Bytes hashed at once with numpy
+CHUNK_BLOCK = 256 * 1024
+
+
+# Return the length of the first chunk of data, hashing a block of bytes at a time with numpy.
+# The gear hash after a byte only depends on the 64 bytes up to it, so the hash at every position of a block is a sum
+# of 64 shifted gear values, built in 6 doubling steps. Cuts at the same places as the loop in chunk_cut
+def chunk_cut_numpy(data, end):
+    normal = min(end, CHUNK_AVG)
+    view = numpy.frombuffer(data, numpy.uint8, end)
+    gear = numpy.array(CHUNK_GEAR, numpy.uint64)
+    start = CHUNK_MIN
+    while start < end:
+        stop = min(start + CHUNK_BLOCK, end)
+        # The 63 bytes before the block feed its first hashes, but nothing before CHUNK_MIN does
+        first = max(CHUNK_MIN, start - 63)
+        h = numpy.zeros(stop - first + 64, numpy.uint64)
+        h[64:] = gear[view[first:stop]]
+        shift = 1
+        while shift < 64:
+            h[shift:] += h[:-shift] << numpy.uint64(shift)
+            shift *= 2
+        h = h[64 + start - first:]
+        hard = max(0, min(normal, stop) - start)
+        hits = numpy.flatnonzero(h[:hard] & numpy.uint64(CHUNK_MASK_HARD) == 0)
+        if not hits.size:
+            hits = numpy.flatnonzero(h[hard:] & numpy.uint64(CHUNK_MASK_EASY) == 0) + hard
+        if hits.size:
+            return start + int(hits[0]) + 1
+        start = stop
+    return end
+
+
+# Return the length of the first chunk of data
+def chunk_cut(data):
+    end = min(len(data), CHUNK_MAX)
+    if end <= CHUNK_MIN:
+        return end
+    if numpy is not None:
+        return chunk_cut_numpy(data, end)
+    normal = min(end, CHUNK_AVG)
+    gear = CHUNK_GEAR
+    h = 0
+    i = CHUNK_MIN
+    while i < normal:
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+        i += 1
+        if not h & CHUNK_MASK_HARD:
+            return i
+    while i < end:
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+        i += 1
+        if not h & CHUNK_MASK_EASY:
+            return i
+    return end
+
+
+# Split a file into chunks and add the ones the store doesn't have yet to the chunks folder.
+# Returns ([chunk digests], bytes written) and None, or None and the error that stopped it
+def store_chunks(file, chunks_folder):
+    chunks = []
+    written = 0
+    try:
+        with open(file, "rb") as f:
+            # Chunks are cut from start on, what is before it is only dropped when reading more
+            data = b""
+            view = memoryview(data)
+            start = 0
+            eof = False
+            while start < len(data) or not eof:
+                if not eof and len(data) - start < CHUNK_MAX:
+                    more = f.read(CHUNK_MAX * 2)
+                    account("read", len(more))
+                    eof = not more
+                    data = data[start:] + more
+                    view = memoryview(data)
+                    start = 0
+                    continue
+                cut = chunk_cut(view[start:])
+                chunk = view[start:start + cut]
+                start += cut
+                digest = hashlib.new(CHUNK_ALGORITHM, chunk).hexdigest()
+                path = join(chunks_folder, digest[:2], digest)
+                if not Path(path).is_file():
+                    makedirs(join(chunks_folder, digest[:2]), exist_ok=True)
+                    # Written aside and renamed, so a chunk under its final name is always complete
+                    temp = f"{path}.{getpid()}.{get_ident()}.tmp"
+                    with open(temp, "wb") as out:
+                        out.write(chunk)
+                        account("write", len(chunk))
+                        forget(out, True)
+                    replace(temp, path)
+                    written += len(chunk)
+                chunks.append(digest)
+            forget(f)
+        return (chunks, written), None
+    except (UnicodeDecodeError, OSError) as error:
+        return None, error
+
+
+# Name of a backup folder or snapshot as a sortable (year, month, day, iteration), or None for any other name
+def backup_key(name):
+    try:
+        date, n = name.split(".")
+        year, month, day = date.split("-")
+        return int(year), int(month), int(day), int(n)
+    except ValueError:
+        return None
+
+
+class ChunkStore:
+    """
+    Repository format for --chunked backups. Files are split into content-defined chunks stored once under
+    META_DIR/chunks by digest, and every backup writes a snapshot to META_DIR/snapshots listing each file of
+    the source with the chunks it is made of. A changed byte in a large file only costs the chunks around it.
+    Snapshots are JSON lines: a header, then one record per directory and per file.
+    """
+
+    def __init__(self, destination):
+        self.root = join(destination, META_DIR)
+        self.chunks = join(self.root, "chunks")
+        self.snapshots = join(self.root, "snapshots")
+        makedirs(self.chunks, exist_ok=True)
+        makedirs(self.snapshots, exist_ok=True)
+
+    # Names of every snapshot, oldest first
+    def names(self):
+        names = [entry.name[:-len(".jsonl")] for entry in scandir(self.snapshots) if entry.name.endswith(".jsonl")]
+        return sorted((name for name in names if backup_key(name)), key=backup_key)
+
+    # Yield the header and every record of a snapshot
+    def read(self, name):
+        with open(join(self.snapshots, name + ".jsonl"), encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    # Files of the newest snapshot taken from source, as {relative path: record}
+    def latest(self, source):
+        for name in reversed(self.names()):
+            records = self.read(name)
+            if next(records).get("source") != abspath(source):
+                continue
+            return {record["file"]: record for record in records if "file" in record}
+        return {}
+
+    # Write the file made of chunks to target
+    def extract(self, chunks, target):
+        with open(target, "wb") as out:
+            for chunk in chunks:
+                with open(join(self.chunks, chunk[:2], chunk), "rb") as f:
+                    out.write(f.read())
+
+
+# Take a --chunked snapshot of source named after destination. Files whose stat matches the previous snapshot
+# reuse its chunk list, the others are chunked on the pool. No snapshot is written when nothing changed
+def backup_chunked(source, destination, store, pool=None, paranoid=False, full=False):
+    pool = pool or HashPool()
+    previous = {} if full else store.latest(source)
+    name = destination.rstrip("/\\").split(slash)[-1]
+    temp = join(store.snapshots, f"{name}.{getpid()}.tmp")
+    changed = full or not previous
+    count = 0
+    written = 0
+    progress = Progress("Chunking:")
+    with open(temp, "w", encoding="utf-8") as out:
+        out.write(json.dumps({"source": abspath(source), "created": datetime.now().isoformat(),
+                              "chunk_algorithm": CHUNK_ALGORITHM}) + "\n")
+
+        # Files that have to be chunked, with their stat. Directories and unchanged files are written as they come
+        def unknown():
+            nonlocal count
+            for key, files in scan_tree(source):
+                out.write(json.dumps({"dir": relpath(key, source)}) + "\n")
+                for file, st in files:
+                    rel = relpath(key + slash + file, source)
+                    count += 1
+                    record = {"file": rel, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino,
+                              "mode": st.st_mode}
+                    old = previous.get(rel)
+                    if not paranoid and old is not None and \
+                            (old["size"], old["mtime_ns"], old["inode"]) == (st.st_size, st.st_mtime_ns, st.st_ino):
+                        record["chunks"] = old["chunks"]
+                        out.write(json.dumps(record) + "\n")
+                        progress.update()
+                    else:
+                        yield key + slash + file, record
+
+        for (file, record), (result, error) in pool.imap(unknown(), store.chunks, lambda item: item[0],
+                                                         store_chunks):
+            progress.update(size=record["size"])
+            if error is not None:
+                hash_error(file, error)
+                continue
+            record["chunks"], new = result
+            if new or record["chunks"] != previous.get(record["file"], {}).get("chunks"):
+                verbose_print(f"New chunks found for file {file}", 1)
+                changed = True
+            written += new
+            out.write(json.dumps(record) + "\n")
+    progress.done()
+    if not changed and count == len(previous):
+        remove(temp)
+        return None
+    # Same naming as the backup folders: the first free iteration of the day
+    while Path(join(store.snapshots, name + ".jsonl")).exists():
+        name = name.split(".")[0] + "." + str(int(name.split(".")[-1]) + 1)
+    replace(temp, join(store.snapshots, name + ".jsonl"))
+    verbose_print(f"Snapshot {name} written, {written} bytes of new chunks", 1)
+    return name
+
+
+# Pack files of a --pack backup are closed once they reach this size, and a new one is started
+PACK_SIZE = 256 * 1024 * 1024
+# Blocks read ahead of the thread that compresses and writes packs
+PACK_QUEUE = 64
+
+
+class Stored:
+    """
+    Compressor and decompressor for packs written without compression.
+    """
+
+    def compress(self, data):
+        return bytes(data)
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+# Compressors and decompressors by --compress name. Each file is compressed on its own so it can be read back alone
+COMPRESSORS = {
+    "none": (Stored, Stored),
+    "gzip": (lambda: zlib.compressobj(6, zlib.DEFLATED, 31), lambda: zlib.decompressobj(31)),
+    "bz2": (bz2.BZ2Compressor, bz2.BZ2Decompressor),
+    "lzma": (lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = (lambda: zstandard.ZstdCompressor().compressobj(),
+                           lambda: zstandard.ZstdDecompressor().decompressobj())
+
+
+class PackStore:
+    """
+    Repository format for --pack backups. Every backup is a folder of META_DIR/packs holding pack files, which
+    are the files of the backup compressed one after the other, and index.jsonl, which tells where each file is.
+    The index is JSON lines: a header, then one record per directory and per file, like chunk store snapshots.
+    """
+
+    def __init__(self, destination):
+        self.root = join(destination, META_DIR, "packs")
+        makedirs(self.root, exist_ok=True)
+
+    # Names of every backup, oldest first
+    def names(self):
+        names = [entry.name for entry in scandir(self.root) if entry.is_dir() and backup_key(entry.name)]
+        return sorted(names, key=backup_key)
+
+    # Yield the header and every record of the index of a backup
+    def read(self, name):
+        with open(join(self.root, name, "index.jsonl"), encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    # Add every packed file hashed with algorithm to index, a DigestIndex, and its size to sizes
+    def add_to(self, index, algorithm, sizes=None):
+        for name in self.names():
+            records = self.read(name)
+            if next(records).get("algorithm") != algorithm:
+                verbose_print(f"Pack {name} was hashed with another algorithm, its files count as new", 1)
+                continue
+            for record in records:
+                if "file" in record:
+                    index.add(record["digest"], name + sep + record["file"], record["size"])
+                    if sizes is not None:
+                        sizes.add(record["size"])
+
+    # Write the file of a record from the index of backup name to target
+    def extract(self, name, record, target, compression="none"):
+        with open(target, "wb") as out:
+            for data in pack_blocks(join(self.root, name, record["pack"]), record["offset"], record["length"],
+                                    compression):
+                out.write(data)
+
+
+# Yield the data of the file stored at offset in a pack, length bytes long, a block at a time
+def pack_blocks(pack_path, offset, length, compression="none"):
+    decompressor = COMPRESSORS[compression][1]()
+    with open(pack_path, "rb") as pack:
+        pack.seek(offset)
+        while length > 0:
+            data = pack.read(min(length, COPY_BUFFER))
+            if not data:
+                raise OSError(f"Pack {pack_path} is truncated")
+            account("read", len(data))
+            length -= len(data)
+            yield decompressor.decompress(data)
+
+
+class PackError(Exception):
+    """
+    Writing a pack failed, like when the destination is full. The whole pack is given up.
+    """
+
+
+class PackWriter:
+    """
+    Writes the files of a --pack backup to folder. Files are read by the caller and handed over a block at a time,
+    then compressed and written by a background thread. If the thread fails, the next call raises PackError.
+    """
+
+    def __init__(self, folder, header, compression="none"):
+        self.folder = folder
+        self.compressor = COMPRESSORS[compression][0]
+        self.queue = Queue(PACK_QUEUE)
+        self.number = 0
+        self.pack = open(join(folder, f"{self.number:05}.pack"), "wb")
+        self.index = open(join(folder, "index.jsonl"), "w", encoding="utf-8")
+        self.index.write(json.dumps(header) + "\n")
+        # File being written, with the compressor of its data
+        self.record = None
+        self.compressing = None
+        # What stopped the thread, if anything
+        self.error = None
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Hand an item to the thread, unless it already failed
+    def put(self, kind, item):
+        if self.error is not None:
+            raise PackError(self.error)
+        self.queue.put((kind, item))
+
+    def dir(self, path):
+        self.put("dir", path)
+
+    # Start a file, described by record. Its data follows through write, then end gives its digest
+    def begin(self, record):
+        self.put("begin", record)
+
+    def write(self, data):
+        self.put("data", data)
+
+    def end(self, digest=None):
+        self.put("end", digest)
+
+    # Drop the file begun last, it could not be read to the end
+    def abort(self):
+        self.put("abort", None)
+
+    def run(self):
+        while True:
+            kind, item = self.queue.get()
+            if kind == "close":
+                break
+            if self.error is not None:
+                # Keep taking items so the caller never blocks on a full queue
+                continue
+            try:
+                self.handle(kind, item)
+            except Exception as error:
+                self.error = error
+
+    # Write one item to the index or the current pack, starting a new pack between files once it is full
+    def handle(self, kind, item):
+        if kind == "dir":
+            self.index.write(json.dumps({"dir": item}) + "\n")
+        elif kind == "begin":
+            if self.pack.tell() >= PACK_SIZE:
+                self.pack.close()
+                self.number += 1
+                self.pack = open(join(self.folder, f"{self.number:05}.pack"), "wb")
+            self.record = item
+            self.record["pack"] = f"{self.number:05}.pack"
+            self.record["offset"] = self.pack.tell()
+            self.compressing = self.compressor()
+        elif kind == "data":
+            data = self.compressing.compress(item)
+            self.pack.write(data)
+            account("write", len(data))
+        elif kind == "end":
+            self.pack.write(self.compressing.flush())
+            self.record["length"] = self.pack.tell() - self.record["offset"]
+            self.record["digest"] = item
+            self.index.write(json.dumps(self.record) + "\n")
+        elif kind == "abort":
+            self.record = None
+
+    # Wait for the thread to write everything and close the pack and the index. Raises PackError if it failed
+    def close(self):
+        self.queue.put(("close", None))
+        self.thread.join()
+        for f in (self.pack, self.index):
+            try:
+                if self.error is None:
+                    f.flush()
+                    fsync(f.fileno())
+                f.close()
+            except OSError as error:
+                self.error = self.error or error
+        if self.error is not None:
+            raise PackError(self.error)
+
+
+# Write contents into a new --pack backup named after destination, the first free iteration of the day. Files
+# whose digest is not in digests are hashed as they are read, and recorded in the manifest for the next run
+def pack_files(contents, source, destination, store, algorithm="sha1", digests=None, manifest=None,
+               compression="none"):
+    name = destination.rstrip("/\\").split(slash)[-1]
+    # Backup folders and packs share names, so any backup can be told by its name
+    folders = destination.rstrip("/\\")[:-len(name)]
+    # Left behind by runs that were interrupted
+    for entry in scandir(store.root):
+        if entry.name.endswith(".tmp") and entry.is_dir():
+            rmtree(entry.path, ignore_errors=True)
+    while Path(join(store.root, name)).exists() or Path(folders + name).exists():
+        name = name.split(".")[0] + "." + str(int(name.split(".")[-1]) + 1)
+    # Written under a temporary name then renamed, so a pack folder is always complete
+    temp = join(store.root, f"{name}.{getpid()}.tmp")
+    mkdir(temp)
+    writer = PackWriter(temp, {"source": abspath(source), "created": datetime.now().isoformat(),
+                               "algorithm": algorithm, "compression": compression}, compression)
+    length_bytes = 0
+    for key in contents:
+        for file in contents[key]:
+            try:
+                length_bytes += stat(key + slash + file).st_size
             except OSError:
-                verbose_print(f"Invalid argument: {destination}{slash}{source_replaced}, "
-                              f"possibly file of zero size. Skipping.", 1)
-            printprogressbar(progress+1, length, prefix='Progress:', suffix='Complete', length=50)
-            progress += 1
+                pass
+    progress = Progress("Packing:", get_len(contents), length_bytes)
+    try:
+        write_pack(contents, source, writer, progress, algorithm, digests, manifest)
+        writer.close()
+    except PackError as error:
+        # Stop the thread and let go of the files before removing them
+        try:
+            writer.close()
+        except PackError:
+            pass
+        verbose_print(f"Error writing pack {name}: {error.args[0]}", 0)
+        rmtree(temp, ignore_errors=True)
+        raise SystemExit(1)
+    progress.done()
+    replace(temp, join(store.root, name))
+    verbose_print(f"Pack {name} written", 1)
+    return name
+
+
+# Read the files of contents into writer, a PackWriter, hashing the ones whose digest is not in digests
+def write_pack(contents, source, writer, progress, algorithm="sha1", digests=None, manifest=None):
+    for key in contents:
+        writer.dir(relpath(key, source))
+        for file in contents[key]:
+            path = key + slash + file
+            digest = digests.get(path) if digests is not None else None
+            hsh = get_hasher(algorithm)() if digest is None else None
+            verbose_print(f"En cours d'archivage {file}", 2)
+            try:
+                with open(path, "rb") as f:
+                    st = fstat(f.fileno())
+                    writer.begin({"file": relpath(path, source), "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                                  "mode": st.st_mode})
+                    try:
+                        while True:
+                            data = f.read(COPY_BUFFER)
+                            if not data:
+                                break
+                            account("read", len(data))
+                            if hsh is not None:
+                                hsh.update(data)
+                            writer.write(data)
+                    except OSError:
+                        writer.abort()
+                        raise
+                    forget(f)
+            except OSError as error:
+                verbose_print(f"Could not pack {path}: {error}. Skipping.", 1)
+                continue
+            if hsh is not None:
+                digest = hsh.hexdigest()
+                if manifest is not None:
+                    manifest.record_source(path, st, algorithm, digest)
+            writer.end(digest)
+            progress.update(size=st.st_size)
+
+
+SNAPSHOTS_NAME = "snapshots.db"
+
+
+# Inode and mtime_ns of a backup folder as JSON, which tell it apart from a later folder under the same name
+def folder_info(folder):
+    st = stat(folder)
+    return json.dumps({"inode": st.st_ino, "mtime_ns": st.st_mtime_ns})
+
+
+class SnapshotIndex:
+    """
+    Index of every version of every file in the backups of a destination: backup folders, packs and chunk store
+    snapshots alike. Stored as an SQLite database in META_DIR, so queries don't walk the backups. Backups are
+    indexed once, except the newest folder, which --watch and --resume can still add files to, and folders that
+    are not the one indexed under their name anymore.
+    """
+
+    def __init__(self, destination):
+        self.root = destination
+        makedirs(join(destination, META_DIR), exist_ok=True)
+        self.db = sqlite3.connect(join(destination, META_DIR, SNAPSHOTS_NAME), check_same_thread=False)
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        # created is a timestamp, info the JSON header of packs and chunk store snapshots, or the inode and
+        # mtime_ns of folders
+        self.db.execute("CREATE TABLE IF NOT EXISTS backups (id INTEGER PRIMARY KEY, name TEXT, kind TEXT, "
+                        "created REAL, info TEXT, UNIQUE (name, kind))")
+        # location is where the data is in packs and chunk stores, as JSON
+        self.db.execute("CREATE TABLE IF NOT EXISTS versions (path TEXT, backup INTEGER, size INTEGER, "
+                        "mtime_ns INTEGER, location TEXT, PRIMARY KEY (path, backup)) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS versions_by_backup ON versions (backup)")
+        self.db.commit()
+
+    # Every backup of the destination as {(name, kind): path of its folder, pack folder or snapshot}
+    def backups(self):
+        found = {}
+        for entry in scandir(self.root):
+            if entry.is_dir() and backup_key(entry.name):
+                found[(entry.name, "folder")] = entry.path
+        packs = join(self.root, META_DIR, "packs")
+        if Path(packs).is_dir():
+            for name in PackStore(self.root).names():
+                found[(name, "pack")] = join(packs, name)
+        snapshots = join(self.root, META_DIR, "snapshots")
+        if Path(snapshots).is_dir():
+            for name in ChunkStore(self.root).names():
+                found[(name, "chunked")] = join(snapshots, name + ".jsonl")
+        return found
+
+    # Bring the index in line with the backups on disk
+    def refresh(self):
+        found = self.backups()
+        folders = [name for name, kind in found if kind == "folder"]
+        newest = max(folders, key=backup_key) if folders else None
+        known = set()
+        for backup, name, kind, info in self.db.execute("SELECT id, name, kind, info FROM backups").fetchall():
+            path = found.get((name, kind))
+            # A folder whose name was reused, as when old backups are rotated out, has another inode or mtime
+            if path is None or kind == "folder" and (name == newest or info != folder_info(path)):
+                self.db.execute("DELETE FROM versions WHERE backup = ?", (backup,))
+                self.db.execute("DELETE FROM backups WHERE id = ?", (backup,))
+            else:
+                known.add((name, kind))
+        for (name, kind), path in sorted(found.items(), key=lambda item: backup_key(item[0][0])):
+            if (name, kind) in known:
+                continue
+            verbose_print(f"Indexing backup {name} ({kind})", 2)
+            if kind == "folder":
+                self.add_folder(name, path)
+            else:
+                self.add_records(name, kind, path)
+        self.db.commit()
+
+    # A folder is dated by its name, the start of the day it was backed up. Its mtime moves when it is copied
+    # elsewhere, or when --resume or --watch add to it on a later day
+    def add_folder(self, name, folder):
+        year, month, day, iteration = backup_key(name)
+        backup = self.db.execute("INSERT INTO backups (name, kind, created, info) VALUES (?, 'folder', ?, ?)",
+                                 (name, datetime(year, month, day).timestamp(), folder_info(folder))).lastrowid
+        for key, files in scan_tree(folder):
+            self.db.executemany("INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, NULL)",
+                                [(relpath(key + slash + file, folder), backup, st.st_size, st.st_mtime_ns)
+                                 for file, st in files if not TEMP_NAME.search(file)])
+
+    # Index a pack or a chunk store snapshot from its records
+    def add_records(self, name, kind, path):
+        records = PackStore(self.root).read(name) if kind == "pack" else ChunkStore(self.root).read(name)
+        header = next(records)
+        created = datetime.fromisoformat(header["created"]).timestamp()
+        backup = self.db.execute("INSERT INTO backups (name, kind, created, info) VALUES (?, ?, ?, ?)",
+                                 (name, kind, created, json.dumps(header))).lastrowid
+        rows = []
+        for record in records:
+            if "file" not in record:
+                continue
+            if kind == "pack":
+                location = {"pack": record["pack"], "offset": record["offset"], "length": record["length"],
+                            "mode": record["mode"]}
+            else:
+                location = {"chunks": record["chunks"], "mode": record["mode"]}
+            rows.append((normpath(record["file"]), backup, record["size"], record["mtime_ns"], json.dumps(location)))
+        self.db.executemany("INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?)", rows)
+
+    # Yield (path, size, mtime_ns, name, kind, info, location) for the newest version, at or before the timestamp
+    # at, of every file under path (path itself if it is a file, everything for "."). With pattern, the files
+    # matching that glob instead
+    def query(self, path=".", at=None, pattern=None):
+        at = at if at is not None else datetime.now().timestamp()
+        if pattern is not None:
+            where, args = "path GLOB ?", (pattern,)
+        elif path == ".":
+            where, args = "1", ()
+        else:
+            # Everything sorting between "path/" and "path/" followed by the highest character is below path
+            where, args = "(path = ? OR (path > ? AND path < ?))", (path, path + sep, path + sep + "\U0010ffff")
+        rows = self.db.execute(f"SELECT path, size, mtime_ns, name, kind, info, location, created FROM versions "
+                               f"JOIN backups ON backup = id WHERE created <= ? AND {where} ORDER BY path",
+                               (at,) + args)
+        current = None
+        best = None
+        for row in rows:
+            if row[0] != current:
+                if best is not None:
+                    yield best[:-1]
+                current = row[0]
+                best = row
+            # Backups are named by day and iteration within the day, created only decides between kinds
+            elif (backup_key(row[3]), row[-1]) > (backup_key(best[3]), best[-1]):
+                best = row
+        if best is not None:
+            yield best[:-1]
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+# Get a timestamp from an --at date. A date alone means the end of that day
+def parse_date(date):
+    when = datetime.fromisoformat(date.strip())
+    if len(date.strip()) == 10:
+        return when.timestamp() + 24 * 3600 - 0.001
+    return when.timestamp()
+
+
+# Write one version, as yielded by SnapshotIndex.query, to target. Returns target and None, or None and the error
+def restore_version(version, target):
+    path, size, mtime_ns, name, kind, info, location = version
+    try:
+        makedirs(dirname(target), exist_ok=True)
+        if kind == "folder":
+            result, error = copy_file(join(cli.args["-d"], name, path), target)
+            return (target, error) if error is None else (None, error)
+        location = json.loads(location)
+        if kind == "pack":
+            PackStore(cli.args["-d"]).extract(name, location, target, json.loads(info).get("compression", "none"))
+        else:
+            ChunkStore(cli.args["-d"]).extract(location["chunks"], target)
+        chmod(target, location["mode"] & 0o7777)
+        utime(target, ns=(mtime_ns, mtime_ns))
+        return target, None
+    except (OSError, ValueError, zlib.error, lzma.LZMAError) as error:
+        return None, error
+
+
+# Run the restore, ls or find command
+def run_command(command):
+    index = SnapshotIndex(cli.args["-d"])
+    index.refresh()
+    try:
+        at = parse_date(cli.args["--at"]) if "--at" in cli.args else None
+    except ValueError:
+        print(f"Error: --at expects a date like 2024-01-31 or 2024-01-31T18:00, not {cli.args['--at']}")
+        raise SystemExit
+    path = normpath(cli.args.get("-p", ".")).strip(sep) or "."
+    if command == "ls":
+        # Folders are shown once, with a slash, files with their size and the backup they come from
+        shown = set()
+        prefix = "" if path == "." else path + sep
+        for version in index.query(path, at):
+            rest = version[0][len(prefix):] if version[0] != path else basename(path)
+            child, below, _ = rest.partition(sep)
+            if below and child not in shown:
+                shown.add(child)
+                print(child + sep)
+            elif not below:
+                print(f"{child}\t{version[1]}\t{version[3]}")
+    elif command == "find":
+        if "-p" not in cli.args:
+            print("Error: find needs a pattern, use -p [pattern]")
+            raise SystemExit
+        for version in index.query(at=at, pattern=cli.args["-p"]):
+            print(f"{version[0]}\t{version[1]}\t{version[3]}")
+    else:
+        if "-o" not in cli.args:
+            print("Error: restore needs a target folder, use -o [target]")
+            raise SystemExit
+        versions = list(index.query(path, at))
+        if not versions:
+            verbose_print(f"Nothing backed up under {path} at that date", 0)
+        progress = Progress("Restoring:", len(versions), sum(version[1] for version in versions))
+        with ThreadPoolExecutor(max(1, cli.jobs)) as executor:
+            targets = [join(cli.args["-o"], version[0]) for version in versions]
+            for version, (target, error) in zip(versions, executor.map(restore_version, versions, targets)):
+                if error is not None:
+                    verbose_print(f"Could not restore {version[0]} from {version[3]}: {error}", 0)
+                else:
+                    verbose_print(f"Restored {version[0]} from {version[3]}", 2)
+                progress.update(size=version[1])
+        progress.done()
+    index.close()
+
+
+VERIFY_NAME = "verify.json"
+
+
+# Hash one item of verify_backups, a (kind, path, algorithm, location, compression) tuple, the way it was recorded.
+# Runs on a HashPool like hash_file, and returns the digest and None, or None and the error that stopped it
+def verify_item(item, algorithm=None):
+    kind, path, algorithm, location, compression = item
+    if kind != "pack":
+        return hash_file(path, algorithm)
+    hsh = get_hasher(algorithm)()
+    try:
+        for data in pack_blocks(path, location["offset"], location["length"], compression):
+            hsh.update(data)
+        return hsh.hexdigest(), None
+    except (OSError, ValueError, EOFError, zlib.error, lzma.LZMAError) as error:
+        return None, error
+
+
+# Everything in destination with a recorded digest, as (id, size, expected digest, item for verify_item), by id
+def verify_items(destination):
+    items = []
+    if Path(join(destination, META_DIR, MANIFEST_NAME)).is_file():
+        db = sqlite3.connect(join(destination, META_DIR, MANIFEST_NAME))
+        for path, size, algorithm, digest in db.execute("SELECT path, size, algorithm, digest FROM files "
+                                                        "JOIN digests USING (path)"):
+            items.append((f"folder:{path}", size, digest, ("folder", join(destination, path), algorithm, None, None)))
+        db.close()
+    if Path(join(destination, META_DIR, "packs")).is_dir():
+        store = PackStore(destination)
+        for name in store.names():
+            records = store.read(name)
+            header = next(records)
+            for record in records:
+                if "file" in record:
+                    items.append((f"pack:{name}{sep}{record['file']}", record["size"], record["digest"],
+                                  ("pack", join(store.root, name, record["pack"]), header["algorithm"], record,
+                                   header["compression"])))
+    chunks = join(destination, META_DIR, "chunks")
+    if Path(chunks).is_dir():
+        # Chunks are named after their digest
+        for key, files in scan_tree(chunks):
+            for file, st in files:
+                if ".tmp" not in file:
+                    items.append((f"chunk:{file}", st.st_size, file,
+                                  ("chunk", key + slash + file, CHUNK_ALGORITHM, None, None)))
+    items.sort(key=lambda item: item[0])
+    return items
+
+
+# Check part of the backups in destination against their recorded digests, starting where the last run stopped.
+# sample is a share of all the bytes (like 0.1) or a number of bytes (like 10G) to read, everything by default
+# Writes a JSON report to report, or prints it. Returns the number of missing or corrupted files
+def verify_backups(destination, sample="1", pool=None, report=None):
+    pool = pool or HashPool()
+    started = datetime.now().isoformat()
+    items = verify_items(destination)
+    total = sum(item[1] for item in items)
+    budget = total * float(sample) if "." in sample or sample == "1" else parse_size(sample)
+    state_path = join(destination, META_DIR, VERIFY_NAME)
+    try:
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    # Carry on after the last item checked by the previous run, going back to the start at the end
+    first = bisect_right([item[0] for item in items], state.get("cursor", ""))
+    chosen = []
+    size = 0
+    wrapped = False
+    for i in range(len(items)):
+        item = items[(first + i) % len(items)]
+        if chosen and size + item[1] > budget:
+            break
+        chosen.append(item)
+        size += item[1]
+        wrapped = wrapped or first + i == len(items) - 1
+    problems = []
+    progress = Progress("Verifying:", len(chosen), size)
+    for (name, length, expected, item), (digest, error) in pool.imap(chosen, None, lambda item: item[3],
+                                                                     verify_item):
+        progress.update(size=length)
+        if isinstance(error, FileNotFoundError):
+            problems.append({"id": name, "problem": "missing", "path": item[1]})
+        elif error is not None:
+            problems.append({"id": name, "problem": "unreadable", "path": item[1], "error": str(error)})
+        elif digest != expected:
+            problems.append({"id": name, "problem": "corrupted", "path": item[1], "expected": expected,
+                             "actual": digest})
+        else:
+            continue
+        verbose_print(f"Verification failed for {item[1]}: {problems[-1]['problem']}", 1)
+    progress.done()
+    cursor = chosen[-1][0] if chosen else ""
+    temp = f"{state_path}.{getpid()}.tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump({"cursor": cursor, "verified": datetime.now().isoformat()}, f)
+    replace(temp, state_path)
+    result = {"destination": abspath(destination), "started": started, "finished": datetime.now().isoformat(),
+              "checked_files": len(chosen), "checked_bytes": size, "total_files": len(items), "total_bytes": total,
+              "cursor": cursor, "wrapped": wrapped, "problems": problems}
+    verbose_print(f"Verified {len(chosen)} of {len(items)} files, {len(problems)} problems", 1)
+    if report is not None:
+        with open(report, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+    return len(problems)
+
+
+# Back up what changed in the source since the last run into a new backup folder, as a plain run does
+def backup_incremental():
+    # verbose_print("Hashing baseline contents", 1)
+    cli.baseline_sizes = set()
+    cli.baseline_hashes = destination_hashes(cli.args["-d"], cli.algorithm, cli.manifest, cli.pool, cli.baseline_sizes,
+                                             "--paranoid" in cli.args)
+    # Files in packs are backed up too
+    if "--pack" in cli.args or Path(join(cli.args["-d"], META_DIR, "packs")).is_dir():
+        PackStore(cli.args["-d"]).add_to(cli.baseline_hashes, cli.algorithm, cli.baseline_sizes)
+    # verbose_print("Getting list of changed files", 1)
+    cli.source_digests = {}
+    # With --link or --reflink, unchanged files are linked into the new backup too
+    if "--link" in cli.args or "--reflink" in cli.args:
+        cli.source_unchanged = {}
+    cli.source_moved = {}
+    cli.source_contents = compare_hashes(cli.src, cli.baseline_hashes, cli.algorithm, cli.source_digests,
+                                         cli.manifest, "--paranoid" in cli.args, cli.pool,
+                                         cli.source_unchanged, cli.baseline_sizes, cli.source_moved)
+    if "--pack" in cli.args and (get_len(cli.source_contents) > 0 or get_len(cli.source_moved) > 0):
+        # Packs can't link, moved files are packed again at their new path
+        for key in cli.source_moved:
+            cli.source_contents[key].extend(file for file, digest in cli.source_moved[key])
+            cli.source_digests.update({key + slash + file: digest for file, digest in cli.source_moved[key]})
+        pack_files(cli.source_contents, cli.src, cli.dst, PackStore(cli.args["-d"]), cli.algorithm,
+                   cli.source_digests, cli.manifest, cli.compression)
+    elif get_len(cli.source_contents) > 0 or get_len(cli.source_moved) > 0:
+        # verbose_print("Copying contents to destination", 1)
+        # Moved files are linked at their new path, so the backup records where they went
+        linked = cli.source_unchanged if cli.source_unchanged is not None else cli.source_moved
+        copyfiles(cli.source_contents, cli.src, cli.dst, cli.manifest, cli.source_digests, cli.algorithm,
+                  cli.jobs, cli.large_jobs, linked, "--reflink" in cli.args, cli.resume, None, cli.journal)
+    elif cli.resume:
+        # The interrupted backup had already copied everything
+        cli.journal.finish()
+    # Resuming only applies to the first pass
+    cli.resume = False
+
+
+# inotify_init1 flag and event masks, from <sys/inotify.h>
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+# Size of struct inotify_event without its name: wd, mask, cookie and len
+INOTIFY_EVENT = struct.calcsize("iIII")
+# Seconds without new events before a batch of changed files is backed up, most files in a batch, and seconds
+# between two full passes over the source that catch changes inotify missed
+WATCH_DEBOUNCE = 2
+WATCH_BATCH = 10000
+WATCH_RECONCILE = 3600
+
+
+class Inotify:
+    """
+    Watches every folder of a tree for files written or moved into it, with Linux inotify called through ctypes.
+    """
+
+    def __init__(self, folder):
+        libc = CDLL(find_library("c"), use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), strerror(get_errno()))
+        # Folder of every watch descriptor
+        self.folders = {}
+        # Set when the kernel dropped events, only a full pass can tell what changed then
+        self.overflowed = False
+        for key, files in scan_tree(folder):
+            self.add(key)
+
+    def add(self, folder):
+        wd = self.add_watch(self.fd, fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd < 0:
+            verbose_print(f"Could not watch {folder}: {strerror(get_errno())}", 1)
+        else:
+            self.folders[wd] = folder
+
+    # Wait up to timeout seconds (forever with None) for events, and return the paths of the files they are about
+    def read(self, timeout=None):
+        if not select([self.fd], [], [], timeout)[0]:
+            return []
+        data = read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = fsdecode(data[offset + INOTIFY_EVENT:offset + INOTIFY_EVENT + length].rstrip(b"\0"))
+            offset += INOTIFY_EVENT + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+            elif wd in self.folders and mask & IN_ISDIR:
+                # Files can land in a new folder before it is watched, so all of them count as changed. Watching
+                # a moved folder again also points its watches, and the ones below it, to the new path
+                for key, files in scan_tree(self.folders[wd] + slash + name):
+                    self.add(key)
+                    paths.extend(key + slash + file for file, st in files)
+            elif wd in self.folders and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                paths.append(self.folders[wd] + slash + name)
+        return paths
+
+    def close(self):
+        close(self.fd)
+
+
+# Get the newest backup folder of date in destination, or None if that day has none yet
+def current_backup(destination, date):
+    keys = []
+    for entry in scandir(destination):
+        key = backup_key(entry.name)
+        if key is not None and key[:3] == (date.year, date.month, date.day) and entry.is_dir():
+            keys.append(key)
+    if not keys:
+        return None
+    return f"{destination}{date.year}-{date.month}-{date.day}.{max(keys)[3]}"
+
+
+# Back up the files at paths into the newest backup folder of the day, next to what is already there
+def backup_paths(paths):
+    cli.current_date = datetime.now()
+    folder = current_backup(cli.args["-d"], cli.current_date)
+    if folder is None:
+        # Nothing was backed up today yet, a full pass starts the day's folder
+        cli.dst = f"{cli.args['-d']}{cli.current_date.year}-{cli.current_date.month}-{cli.current_date.day}.1"
+        backup_incremental()
+        return
+    tree = {}
+    for path in paths:
+        try:
+            st = stat(path)
+        except OSError:
+            # Gone again before it could be backed up
+            continue
+        if S_ISREG(st.st_mode):
+            key, _, file = path.rpartition(slash)
+            tree.setdefault(key, []).append((file, st))
+    digests = {}
+    moved = {}
+    contents = compare_hashes(cli.src, cli.baseline_hashes, cli.algorithm, digests, cli.manifest,
+                              "--paranoid" in cli.args, cli.pool, None, None, moved, tree.items())
+    if get_len(contents) > 0 or get_len(moved) > 0:
+        copyfiles(contents, cli.src, folder, cli.manifest, digests, cli.algorithm, cli.jobs, cli.large_jobs, moved,
+                  "--reflink" in cli.args, True, cli.baseline_hashes)
+    cli.manifest.db.commit()
+
+
+# Back up changed files a few seconds after they are written, until interrupted. Only the changed files are
+# hashed, and a full pass runs every WATCH_RECONCILE seconds, or when inotify lost events
+def watch_source():
+    inotify = Inotify(cli.src)
+    verbose_print(f"Watching {cli.src} for changes", 1)
+    pending = set()
+    last_event = reconciled = monotonic()
+    try:
+        while True:
+            now = monotonic()
+            if pending:
+                timeout = max(0, min(last_event + WATCH_DEBOUNCE, reconciled + WATCH_RECONCILE) - now)
+            else:
+                timeout = max(0, reconciled + WATCH_RECONCILE - now)
+            paths = inotify.read(timeout)
+            now = monotonic()
+            if paths:
+                pending.update(paths)
+                last_event = now
+            if inotify.overflowed or now - reconciled >= WATCH_RECONCILE:
+                verbose_print("Checking the whole source for missed changes", 1)
+                inotify.overflowed = False
+                pending.clear()
+                cli.current_date = datetime.now()
+                cli.dst = f"{cli.args['-d']}{cli.current_date.year}-{cli.current_date.month}-" \
+                    f"{cli.current_date.day}.1"
+                backup_incremental()
+                reconciled = monotonic()
+            elif pending and (now - last_event >= WATCH_DEBOUNCE or len(pending) >= WATCH_BATCH):
+                verbose_print(f"Backing up {len(pending)} changed files", 1)
+                backup_paths(sorted(pending))
+                pending.clear()
+    except KeyboardInterrupt:
+        verbose_print("Stopped watching", 1)
+    finally:
+        inotify.close()
 
 
 # Get the OS type (Windows, Mac, Linux)
@@ -375,9 +2415,113 @@ if __name__ == '__main__':
             # Check that the program was run with valid switches and arguments
             # This also maps the arguments to a dictionary
             cli.check_switches()
-            cli.src = cli.args["-s"]
+            if "--watch" in cli.args and (platf != "Linux" or "-a" in cli.args or "--chunked" in cli.args):
+                print("Error: --watch needs Linux and an incremental backup, it doesn't work with -a or --chunked")
+                raise SystemExit
+            cli.compression = cli.args.get("--compress", "none").strip().lower()
+            if cli.compression not in COMPRESSORS:
+                print(f"Error: Unknown compression {cli.compression}, use one of {', '.join(COMPRESSORS)}"
+                      + ("" if zstandard is not None else ". zstd needs the zstandard package"))
+                raise SystemExit
+            if "--pack" in cli.args and any(x in cli.args for x in ("--link", "--reflink", "--chunked", "--watch")):
+                print("Error: --pack doesn't work with --link, --reflink, --chunked or --watch")
+                raise SystemExit
+            # Without -h, the algorithm recorded in the manifest is used
+            cli.algorithm = None
+            if "-h" in cli.args:
+                try:
+                    cli.algorithm = parse_algorithm(cli.args["-h"])
+                except ValueError as error:
+                    # Falling back to another algorithm would have the manifest hash every backed up file again
+                    print(f"Error: {error.args[0]}")
+                    raise SystemExit
+            try:
+                cli.jobs = int(cli.args.get("-j", 1))
+                cli.large_jobs = int(cli.args.get("--large-jobs", 2))
+                set_read_size(parse_size(cli.args.get("--buffer-size", "64K")))
+            except ValueError:
+                print("Error: -j and --large-jobs expect a number of jobs, --buffer-size a size like 256K or 1M")
+                raise SystemExit
+            # Priorities and I/O limits go first, so every thread and process started afterwards gets them
+            try:
+                bwlimit = cli.args.get("--bwlimit", "0").split(":")
+                configure_io(parse_size(bwlimit[0]), parse_size(bwlimit[-1]), int(cli.args.get("--iops", 0)),
+                             "--drop-cache" in cli.args)
+                set_priority(int(cli.args["--nice"]) if "--nice" in cli.args else None, cli.args.get("--ionice"))
+            except (ValueError, KeyError):
+                print("Error: --bwlimit expects a size per second like 50M (or 50M:20M for reads:writes), --iops and "
+                      "--nice a number, --ionice idle, best-effort or realtime with an optional :level")
+                raise SystemExit
+            except OSError as error:
+                # Like a negative --nice without being root
+                print(f"Error: Could not set the priority: {error.strerror}")
+                raise SystemExit
+            cli.pool = HashPool(cli.jobs, "--processes" in cli.args)
             cli.dst = f'{cli.args["-d"]}{str(cli.current_date.year)}-{str(cli.current_date.month)}-' \
                 f'{str(cli.current_date.day)}.1'
+            # The manifest lives in the destination, so it has to exist before anything else
+            if not Path(cli.args["-d"]).is_dir():
+                if "-a" in cli.args:
+                    print(f"Error, could not make directory {cli.dst}. "
+                          f"Path may be wrong. Make sure your destination already exists")
+                else:
+                    verbose_print("No Baseline Contents. Exiting", 0)
+                cli.pool.close()
+                raise SystemExit
+            # restore, ls and find only read the backups
+            if cli.command == "verify":
+                try:
+                    failed = verify_backups(cli.args["-d"], cli.args.get("--sample", "1"), cli.pool,
+                                            cli.args.get("-o"))
+                except ValueError:
+                    print("Error: --sample expects a share of the backups like 0.1, or a size like 10G")
+                    raise SystemExit
+                cli.pool.close()
+                # A failed verification is an error for whoever runs it from a script
+                raise SystemExit(1 if failed else 0)
+            if cli.command is not None:
+                run_command(cli.command)
+                cli.pool.close()
+                raise SystemExit
+            # Regenerate the manifest from what is actually on disk, then stop
+            if "--rebuild-index" in cli.args:
+                cli.manifest = Manifest(cli.args["-d"])
+                cli.algorithm = cli.manifest.use_algorithm(cli.algorithm)
+                cli.manifest.clear()
+                verbose_print("Rebuilding manifest of the destination", 1)
+                cli.baseline_hashes = destination_hashes(cli.args["-d"], cli.algorithm, cli.manifest, cli.pool,
+                                                         full=True)
+                cli.manifest.close()
+                cli.pool.close()
+                verbose_print(f"Manifest rebuilt with {len(cli.baseline_hashes)} distinct hashes", 1)
+                raise SystemExit
+            cli.src = cli.args["-s"]
+            # With --chunked, files go to the chunk store instead of a backup folder
+            if "--chunked" in cli.args:
+                verbose_print("Chunking contents into the chunk store", 2)
+                snapshot = backup_chunked(cli.src, cli.dst, ChunkStore(cli.args["-d"]), cli.pool,
+                                          "--paranoid" in cli.args, "-a" in cli.args)
+                cli.pool.close()
+                if "-a" in cli.args:
+                    verbose_print("Done", 1)
+                    raise SystemExit
+                # Nothing changed: wait a little before walking the source again
+                if snapshot is None:
+                    sleep(CHUNK_POLL)
+                continue
+            cli.manifest = Manifest(cli.args["-d"])
+            cli.algorithm = cli.manifest.use_algorithm(cli.algorithm)
+            # A journal left behind means the last backup was cut short
+            cli.journal = Journal(cli.args["-d"])
+            if cli.journal.folder is not None:
+                # The copies it cut short go either way, a run that doesn't resume forgets which PIDs made them
+                cli.journal.clean()
+                if "--resume" in cli.args:
+                    verbose_print(f"Resuming backup {cli.journal.folder}", 1)
+                    cli.dst = cli.args["-d"] + cli.journal.folder
+                    cli.resume = True
+                else:
+                    verbose_print(f"Backup {cli.journal.folder} was interrupted. Use --resume to finish it", 1)
             # If the -a switch is used
             if "-a" in cli.args:
                 # Get the baseline contents
@@ -385,36 +2529,28 @@ if __name__ == '__main__':
                 cli.source_contents = get_baseline(cli.src)
                 # Copy all files from source to destination
                 verbose_print("Copying contents to destination", 1)
-                copyfiles(cli.source_contents, cli.src, cli.dst)
+                if "--pack" in cli.args:
+                    pack_files(cli.source_contents, cli.src, cli.dst, PackStore(cli.args["-d"]), cli.algorithm, {},
+                               cli.manifest, cli.compression)
+                    cli.manifest.close()
+                    cli.pool.close()
+                    verbose_print("Done", 1)
+                    raise SystemExit
+                copyfiles(cli.source_contents, cli.src, cli.dst, cli.manifest, {}, cli.algorithm, cli.jobs,
+                          cli.large_jobs, None, False, cli.resume, None, cli.journal)
+                cli.manifest.close()
+                cli.pool.close()
                 verbose_print("Done", 1)
                 raise SystemExit
             else:
-                # verbose_print("Getting baseline contents", 1)
-                cli.baseline_contents = get_baseline(cli.args["-d"])
-                if len(cli.baseline_contents) > 0:
-                    # verbose_print("Hashing baseline contents", 1)
-                    if "-h" in cli.args:
-                        cli.baseline_hashes = get_hashes(cli.baseline_contents, cli.args["-h"])
-                        # verbose_print("Getting list of changed files", 1)
-                        cli.source_contents = compare_hashes(cli.src, cli.baseline_hashes, cli.args["-h"])
-                    else:
-                        # print("################ -o- ################")
-                        # print(cli.baseline_contents)
-                        # print("################ -o- ################")
-                        cli.baseline_hashes = get_hashes(cli.baseline_contents)
-                        # verbose_print("Getting list of changed files", 1)
-                        cli.source_contents = compare_hashes(cli.src, cli.baseline_hashes)
-                    if get_len(cli.source_contents) > 0:
-                        # verbose_print("Copying contents to destination", 1)
-                        copyfiles(cli.source_contents, cli.src, cli.dst)
-                        # verbose_print("Done", 1)
-                        # raise SystemExit
-                    else:
-                        # verbose_print("No files have been changed. Exiting.", 0)
-                        pass
-                        # raise SystemExit
-                else:
-                    verbose_print("No Baseline Contents. Exiting", 0)
+                backup_incremental()
+                # With --watch, changes keep being backed up as they happen until interrupted
+                if "--watch" in cli.args:
+                    watch_source()
+                    cli.manifest.close()
+                    cli.pool.close()
                     raise SystemExit
+                cli.manifest.close()
+                cli.pool.close()
     else:
         print("Error: No arguments provided.")
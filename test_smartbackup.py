@@ -0,0 +1,252 @@
+"""
+Regression checks for smartbackup. Run with python -m pytest
+"""
+
+import json
+import os
+import random
+import shutil
+
+import pytest
+
+import smartbackup
+from smartbackup import Journal, Manifest, copyfiles, get_baseline, slash
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    smartbackup.cli = smartbackup.Cli()
+    smartbackup.cli.verbosity = 0
+
+
+# Make a source with a few files and an empty destination, as paths ending with a slash like the CLI wants them
+@pytest.fixture
+def tree(tmp_path):
+    source = tmp_path / "src"
+    (source / "sub").mkdir(parents=True)
+    for name in ("f1.txt", "f2.txt", "f3.txt", os.path.join("sub", "s1.txt")):
+        (source / name).write_text(name)
+    destination = tmp_path / "dst"
+    destination.mkdir()
+    return str(source) + slash, str(destination) + slash
+
+
+# Leave a journal behind as a run killed after copying f1.txt and sub/s1.txt into folder would
+def interrupt(source, destination, folder):
+    os.makedirs(destination + folder)
+    journal = Journal(destination)
+    journal.begin(folder)
+    for name in ("f1.txt", os.path.join("sub", "s1.txt")):
+        os.makedirs(os.path.dirname(destination + folder + slash + name), exist_ok=True)
+        with open(source + name, "rb") as src, open(destination + folder + slash + name, "wb") as dst:
+            dst.write(src.read())
+        journal.file(name)
+    journal.out.close()
+
+
+def backed_up(folder):
+    return sorted(os.path.relpath(os.path.join(key, name), folder) for key, _, names in os.walk(folder)
+                  for name in names)
+
+
+def test_run_after_interrupted_run_copies_everything(tree):
+    source, destination = tree
+    interrupt(source, destination, "2024-1-1.1")
+    manifest = Manifest(destination)
+    copyfiles(get_baseline(source), source, destination + "2024-1-1.1", manifest, {}, "sha1",
+              journal=Journal(destination))
+    manifest.close()
+    assert backed_up(destination + "2024-1-1.2") == backed_up(source)
+    assert not os.path.exists(os.path.join(destination, smartbackup.META_DIR, smartbackup.JOURNAL_NAME))
+
+
+def test_resume_skips_what_the_journal_lists(tree):
+    source, destination = tree
+    interrupt(source, destination, "2024-1-1.1")
+    os.remove(destination + "2024-1-1.1" + slash + "f1.txt")
+    manifest = Manifest(destination)
+    copyfiles(get_baseline(source), source, destination + "2024-1-1.1", manifest, {}, "sha1", append=True,
+              journal=Journal(destination))
+    manifest.close()
+    # f1.txt was journaled as done, so resuming leaves it alone
+    assert backed_up(destination + "2024-1-1.1") == sorted(["f2.txt", "f3.txt", os.path.join("sub", "s1.txt")])
+
+
+def test_pack_write_error_fails_cleanly(tree, monkeypatch):
+    source, destination = tree
+
+    # Like a full disk: every write to a pack fails
+    def account(kind, size):
+        if kind == "write":
+            raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(smartbackup, "account", account)
+    monkeypatch.setattr(smartbackup, "PACK_QUEUE", 1)
+    store = smartbackup.PackStore(destination)
+    with pytest.raises(SystemExit):
+        smartbackup.pack_files(get_baseline(source), source, destination + "2024-1-1.1", store)
+    assert os.listdir(store.root) == []
+
+
+# numpy has to cut chunks at the same places as the loop, or a chunk store stops deduplicating when it gets installed
+@pytest.mark.parametrize("size", [smartbackup.CHUNK_MIN - 1, smartbackup.CHUNK_MIN + 100, 3 * 1024 * 1024,
+                                  smartbackup.CHUNK_MAX + 1])
+def test_numpy_chunk_cut_matches_the_loop(size, monkeypatch):
+    pytest.importorskip("numpy")
+    data = random.Random(size).getrandbits(size * 8).to_bytes(size, "little")
+    cuts = smartbackup.chunk_cut(data), smartbackup.chunk_cut(bytes(size))
+    monkeypatch.setattr(smartbackup, "numpy", None)
+    assert (smartbackup.chunk_cut(data), smartbackup.chunk_cut(bytes(size))) == cuts
+
+
+def test_destination_hashes_trusts_the_manifest_except_for_the_newest_folder(tree):
+    source, destination = tree
+    manifest = Manifest(destination)
+    for folder in ("2024-1-1.1", "2024-1-2.1"):
+        copyfiles(get_baseline(source), source, destination + folder, manifest, {}, "sha1")
+    smartbackup.destination_hashes(destination, "sha1", manifest, full=True)
+    # Changes in the newest folder are found by stat, older folders are only read from the manifest
+    with open(destination + "2024-1-2.1" + slash + "f1.txt", "w") as f:
+        f.write("changed")
+    os.remove(destination + "2024-1-2.1" + slash + "f2.txt")
+    index = smartbackup.destination_hashes(destination, "sha1", manifest)
+    assert [path for path, size in index.get(smartbackup.hash_file(source + "f2.txt", "sha1")[0])] == \
+        [os.path.join("2024-1-1.1", "f2.txt")]
+    assert smartbackup.hash_file(destination + "2024-1-2.1" + slash + "f1.txt", "sha1")[0] in index
+    # Deleting a backup folder removes what it held
+    shutil.rmtree(destination + "2024-1-1.1")
+    index = smartbackup.destination_hashes(destination, "sha1", manifest)
+    assert smartbackup.hash_file(source + "f2.txt", "sha1")[0] not in index
+    manifest.close()
+
+
+def test_snapshot_index_dates_folders_by_name_and_notices_reused_names(tree):
+    source, destination = tree
+    for folder in ("2024-1-1.1", "2024-1-1.2", "2024-1-5.1"):
+        copyfiles(get_baseline(source), source, destination + folder)
+    index = smartbackup.SnapshotIndex(destination)
+    index.refresh()
+    # The folders were written today, their names say when they were backed up
+    versions = list(index.query("f1.txt", smartbackup.parse_date("2024-01-01")))
+    assert [version[3] for version in versions] == ["2024-1-1.2"]
+    # Rotate 2024-1-1.2 out and back up into its name again
+    shutil.rmtree(destination + "2024-1-1.2")
+    os.remove(source + "f2.txt")
+    copyfiles(get_baseline(source), source, destination + "2024-1-1.2")
+    os.utime(destination + "2024-1-1.2", ns=(0, 0))
+    index.refresh()
+    files = {version[0]: version[3] for version in index.query(at=smartbackup.parse_date("2024-01-01"))}
+    assert files["f2.txt"] == "2024-1-1.1"
+    assert files["f1.txt"] == "2024-1-1.2"
+    index.close()
+
+
+def test_unfinished_copies_are_not_indexed(tree):
+    source, destination = tree
+    copyfiles(get_baseline(source), source, destination + "2024-1-1.1")
+    with open(destination + "2024-1-1.1" + slash + "big.bin.9999.tmp", "wb") as f:
+        f.write(b"partial")
+    manifest = Manifest(destination)
+    smartbackup.destination_hashes(destination, "sha1", manifest, full=True)
+    assert not any(path.endswith(".tmp") for path, size, digest in manifest.entries("sha1"))
+    manifest.close()
+    index = smartbackup.SnapshotIndex(destination)
+    index.refresh()
+    assert "big.bin.9999.tmp" not in [version[0] for version in index.query()]
+    index.close()
+
+
+# Back up the tree into a folder, with its digests recorded in the manifest like a plain run does
+def backup(source, destination, folder="2024-1-1.1"):
+    manifest = Manifest(destination)
+    copyfiles(get_baseline(source), source, destination + folder, manifest, {}, "sha1")
+    manifest.close()
+
+
+def verify(destination, sample, tmp_path):
+    report = str(tmp_path / "report.json")
+    failed = smartbackup.verify_backups(destination, sample, report=report)
+    with open(report) as f:
+        result = json.load(f)
+    assert failed == len(result["problems"])
+    return result
+
+
+def test_verify_reports_missing_and_corrupted_files(tree, tmp_path):
+    source, destination = tree
+    backup(source, destination)
+    with open(destination + "2024-1-1.1" + slash + "f1.txt", "w") as f:
+        f.write("F1.TXT")
+    os.remove(destination + "2024-1-1.1" + slash + "f2.txt")
+    result = verify(destination, "1", tmp_path)
+    assert result["checked_files"] == result["total_files"] == 4
+    problems = {os.path.basename(problem["path"]): problem["problem"] for problem in result["problems"]}
+    assert problems == {"f1.txt": "corrupted", "f2.txt": "missing"}
+
+
+def test_verify_sample_is_a_share_or_bytes(tree, tmp_path):
+    source, destination = tree
+    backup(source, destination)
+    # "1" is all of it, but "2" is two bytes: the first file goes over that on its own and is checked anyway
+    assert verify(destination, "1", tmp_path)["checked_files"] == 4
+    assert verify(destination, "2", tmp_path)["checked_files"] == 1
+    # f1.txt to f3.txt are 6 bytes and sub/s1.txt 10 bytes, half of the 28 bytes is two files
+    assert verify(destination, "0.5", tmp_path)["checked_files"] == 2
+
+
+def test_verify_cursor_goes_around_the_backups(tree, tmp_path):
+    source, destination = tree
+    backup(source, destination)
+    results = [verify(destination, "2", tmp_path) for _ in range(5)]
+    cursors = [result["cursor"] for result in results]
+    assert cursors[:4] == sorted(cursors[:4]) and len(set(cursors[:4])) == 4
+    assert [result["wrapped"] for result in results] == [False, False, False, True, False]
+    # Back at the start after every file was checked once
+    assert cursors[4] == cursors[0]
+
+
+def test_source_stat_fast_path(tree):
+    source, destination = tree
+    backup(source, destination)
+    manifest = Manifest(destination)
+    baseline = smartbackup.destination_hashes(destination, "sha1", manifest, full=True)
+    assert smartbackup.compare_hashes(source, baseline, "sha1", {}, manifest)[source] == []
+    # Same size, same mtime and same inode: the digest of the last run is trusted and the file is not read
+    st = os.stat(source + "f1.txt")
+    with open(source + "f1.txt", "w") as f:
+        f.write("F1.TXT")
+    os.utime(source + "f1.txt", ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert smartbackup.compare_hashes(source, baseline, "sha1", {}, manifest)[source] == []
+    # --paranoid reads it anyway
+    assert smartbackup.compare_hashes(source, baseline, "sha1", {}, manifest, True)[source] == ["f1.txt"]
+    # So does a new mtime
+    os.utime(source + "f1.txt", ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert smartbackup.compare_hashes(source, baseline, "sha1", {}, manifest)[source] == ["f1.txt"]
+    manifest.close()
+
+
+def test_link_hardlinks_unchanged_files_and_append_never_writes_through_them(tree):
+    source, destination = tree
+    backup(source, destination)
+    old, new = destination + "2024-1-1.1" + slash, destination + "2024-1-2.1" + slash
+    manifest = Manifest(destination)
+    baseline = smartbackup.destination_hashes(destination, "sha1", manifest, full=True)
+    with open(source + "f1.txt", "w") as f:
+        f.write("changed")
+    digests, unchanged = {}, {}
+    contents = smartbackup.compare_hashes(source, baseline, "sha1", digests, manifest, False, None, unchanged)
+    copyfiles(contents, source, new, manifest, digests, "sha1", unchanged=unchanged, index=baseline)
+    for name in ("f2.txt", "f3.txt", os.path.join("sub", "s1.txt")):
+        assert os.path.samefile(old + name, new + name)
+    assert not os.path.samefile(old + "f1.txt", new + "f1.txt")
+    # Adding to the new backup, as --resume and --watch do, replaces a linked file instead of writing into it
+    with open(source + "f2.txt", "w") as f:
+        f.write("changed too")
+    digests = {}
+    contents = smartbackup.compare_hashes(source, baseline, "sha1", digests, manifest)
+    copyfiles(contents, source, new, manifest, digests, "sha1", append=True, index=baseline)
+    manifest.close()
+    with open(old + "f2.txt") as f:
+        assert f.read() == "f2.txt"
+    with open(new + "f2.txt") as f:
+        assert f.read() == "changed too"